@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Awaitable motor control on top of MotorControl.
+
+The serial I/O of MotorControl stays blocking but runs in a worker thread,
+so coroutines never block the event loop. Moves go through the MotionQueue
+of the motor (limits, one move at a time, absolute mode); several axes are
+moved together by one target vector:
+
+    amc = AsyncMotorControl(Motor)
+    await amc.move_to([None, 181., 6.])
+
+QtAsyncBridge runs such coroutines from the Qt GUI and delivers their
+results back on the GUI thread.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+
+class AsyncMotorControl(object):
+    """ Coroutine interface to the axes of a MotorControl. Axes are given
+        by their index in motor.slaves. Targets are absolute positions in
+        mm, one per axis, None keeps an axis where it is (as for
+        MotionQueue.move_to). """
+
+    def __init__(self, motor, poll_interval=0.1):
+        self.motor = motor
+        self.poll_interval = poll_interval  # s, for wait_until_idle
+
+        # one thread: the bus can only do one thing at a time anyway
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def _run(self, func, *args):
+        "runs a blocking MotorControl call in the I/O thread"
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def get_positions(self):
+        "returns positions (mm) of all axes and the time they were read"
+        return await self._run(self.motor.get_positions)
+
+    async def get_states(self, axes=None):
+        "returns the status characters of the given axes (default: all)"
+
+        axes = range(len(self.motor.slaves)) if axes is None else axes
+        commands = [(self.motor.slaves[i], 1, '?ASTAT') for i in axes]
+
+        replies = await self._run(self.motor.serial_batch, commands)
+        return [asw[:1] for asw in replies]
+
+    async def move_to(self, targets, wait=True):
+        """ queues a move to absolute targets (mm), rejected if it leaves the
+            limits (see MotorControl.check_targets)
+            -- wait: return only when all moves are done
+            returns the planned positions of all axes after this move
+        """
+
+        planned = await self._run(self.motor.queue.move_to, targets)
+
+        if wait:
+            await self.wait_until_idle()
+        return planned
+
+    async def move_by(self, distances, wait=True):
+        "queues a move by the given distances (mm), see move_to"
+
+        planned = await self._run(self.motor.queue.move_by, distances)
+
+        if wait:
+            await self.wait_until_idle()
+        return planned
+
+    async def move_if_ready(self, targets):
+        """ queues a move only if the axes it moves stand still
+            returns the planned positions, None if an axis is busy
+        """
+
+        axes = [i for i, target in enumerate(targets) if target is not None]
+        states = await self.get_states(axes)
+        if not all(state == 'R' for state in states):
+            return None
+        return await self.move_to(targets, wait=False)
+
+    async def wait_until_idle(self, axes=None, timeout=None):
+        """ returns when the queue is done and all given axes (default: all)
+            are ready again
+            -- timeout: max. time in s, raises asyncio.TimeoutError
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            if self.motor.queue.idle():
+                states = await self.get_states(axes)
+                if all(state == 'R' for state in states):
+                    return
+            else:
+                states = 'queued moves'
+
+            if deadline is not None and time.monotonic() > deadline:
+                raise asyncio.TimeoutError('axes still moving: {}'.format(states))
+            await asyncio.sleep(self.poll_interval)
+
+
+class QtAsyncBridge(QObject):
+    """ Runs an asyncio event loop next to the Qt event loop. Coroutines are
+        submitted from the GUI, their results come back as a call of the
+        given callback on the GUI thread. """
+
+    finished = pyqtSignal(object, object)  # callback, concurrent future
+
+    def __init__(self):
+        super().__init__()
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       daemon=True)
+        self.thread.start()
+
+        self.finished.connect(self._deliver)
+
+    def submit(self, coro, callback=None):
+        """ schedules a coroutine, callback(result) is called on the GUI
+            thread when it is done. Returns a concurrent.futures.Future. """
+
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if callback is not None:
+            future.add_done_callback(
+                lambda f: self.finished.emit(callback, f))
+        return future
+
+    def _deliver(self, callback, future):
+        try:
+            result = future.result()
+        except Exception:
+            logging.exception('Background motor task failed')
+            return
+        callback(result)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
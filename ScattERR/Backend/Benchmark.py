@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Latency benchmark of the serial control layer (MotorControl).
+
+Times the basic operations against a real port or the simulated PS10 bus
+and reports p50/p95/p99 latency and operations per second. Results can be
+stored as baseline and later runs compared against it, e.g. before a beam
+time. Run from the ScattERR directory:
+
+    python -m Backend.Benchmark --port ps10sim:// --save baseline.json
+    python -m Backend.Benchmark --port COM6 --baseline baseline.json
+
+The exit code is 1 if an operation got slower than the baseline allows.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+
+def measure(func, repeat):
+    "calls func repeat times and returns the durations in s"
+
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    return np.array(times)
+
+
+def summarize(times):
+    "returns count, percentiles (ms) and rate (1/s) of measured durations"
+
+    p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1e3
+    return {"n": len(times), "p50": p50, "p95": p95, "p99": p99,
+            "rate": len(times) / np.sum(times)}
+
+
+def histogram(times, bins=10, width=40):
+    "returns a text histogram of the durations (ms)"
+
+    counts, edges = np.histogram(np.asarray(times) * 1e3, bins=bins)
+    scale = width / max(1, np.max(counts))
+    return "\n".join("  {0:8.2f} ms | {1:s} {2:d}".format(edges[i], "#" * int(c * scale), c)
+                     for i, c in enumerate(counts))
+
+
+def run(motor, port, repeat=50, slow_repeat=5):
+    """ benchmarks the operations of an initialized MotorControl
+        -- repeat: repetitions of single commands
+        -- slow_repeat: repetitions of whole sequences (config, scan, init)
+        returns a dict operation -> durations
+    """
+
+    slave = motor.slaves[0]
+    pvel = motor.read_motor_config()['PVEL']
+
+    def init():
+        motor.ctrl.close()
+        motor.InitMotor(port, calibrate=False, negotiate=False)
+
+    results = {}
+    results["serial_write"] = measure(
+        lambda: motor.serial_write(slave, 1, 'PVEL', pvel), repeat)
+    results["serial_query"] = measure(
+        lambda: motor.serial_query(slave, 1, 'ASTAT'), repeat)
+    results["get_Position"] = measure(motor.get_Position, repeat)
+    results["config_motor"] = measure(
+        lambda: motor.config_motor(slave), slow_repeat)
+    results["find_slaves"] = measure(
+        lambda: motor.find_slaves(10, use_cache=False), slow_repeat)
+    results["InitMotor"] = measure(init, slow_repeat)
+
+    return results
+
+
+def compare(summary, baseline, tolerance=0.2):
+    """ returns the operations whose p95 exceeds the baseline p95 by more
+        than the relative tolerance """
+
+    return [name for name, stats in summary.items() if name in baseline and
+            stats["p95"] > baseline[name]["p95"] * (1. + tolerance)]
+
+
+def report(results, baseline=None, show_histogram=False):
+    "prints the summary table, returns the summary"
+
+    summary = {name: summarize(times) for name, times in results.items()}
+
+    print("{0:14s} {1:>5s} {2:>10s} {3:>10s} {4:>10s} {5:>10s} {6:>10s}"
+          .format("operation", "n", "p50 [ms]", "p95 [ms]", "p99 [ms]", "ops/s",
+                  "p95 base"))
+    for name, stats in summary.items():
+        base = "" if not baseline or name not in baseline else \
+            "{0:10.2f}".format(baseline[name]["p95"])
+        print("{0:14s} {1:5d} {2:10.2f} {3:10.2f} {4:10.2f} {5:10.1f} {6:>10s}"
+              .format(name, stats["n"], stats["p50"], stats["p95"], stats["p99"],
+                      stats["rate"], base))
+        if show_histogram:
+            print(histogram(results[name]))
+
+    return summary
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the serial motor control")
+    parser.add_argument("--port", default="ps10sim://",
+                        help="serial port or pyserial URL (default: simulated bus)")
+    parser.add_argument("-n", "--repeat", type=int, default=50,
+                        help="repetitions of single commands")
+    parser.add_argument("--slow-repeat", type=int, default=5,
+                        help="repetitions of config, scan and init sequences")
+    parser.add_argument("--baseline", help="JSON file to compare against")
+    parser.add_argument("--save", help="store the results as JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative increase of p95 (default 0.2)")
+    parser.add_argument("--histogram", action="store_true",
+                        help="print a latency histogram per operation")
+    parser.add_argument("--trace", help="write a Chrome trace of all commands")
+    parser.add_argument("--negotiate", action="store_true",
+                        help="switch to the fastest serial rate before the run")
+    args = parser.parse_args()
+
+    from ScatERR_MAIN import MotorControl
+
+    motor = MotorControl()
+    if args.trace:
+        from Backend.Trace import SerialTrace
+        trace = SerialTrace()
+        motor.hooks.append(trace)
+
+    if motor.InitMotor(args.port, calibrate=False, negotiate=False) == -1 \
+            or not motor.slaves:
+        print("ERR: no axes found at {0:s}".format(args.port))
+        sys.exit(2)
+
+    if args.negotiate:
+        motor.negotiate_baudrate()
+    print("serial rate: {0:d} baud".format(motor.ctrl.baudrate))
+
+    results = run(motor, args.port, args.repeat, args.slow_repeat)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    summary = report(results, baseline, args.histogram)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if args.trace:
+        print(trace.format_counters())
+        trace.to_chrome_trace(args.trace)
+
+    if baseline:
+        slower = compare(summary, baseline, args.tolerance)
+        for name in slower:
+            print("REGRESSION: {0:s} p95 {1:.2f} ms > baseline {2:.2f} ms"
+                  .format(name, summary[name]["p95"], baseline[name]["p95"]))
+        sys.exit(1 if slower else 0)
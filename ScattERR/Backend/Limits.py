@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Precheck of planned targets against the travel range of the axes and the
+keep-out zones of the scatterers. Works on whole batches of targets (scan
+grids, adjust sequences) in one NumPy pass, so nothing invalid reaches the
+bus. Positions in mm, one column per axis in the order of
+MotorControl.slaves.
+"""
+
+import numpy as np
+
+
+def within_range(targets, limits, lower=0.):
+    """ Returns a boolean array: True for targets inside the travel range.
+        -- targets: array (n_targets, n_axes) or one target (n_axes)
+        -- limits: upper end of the travel range per axis
+        -- lower: lower end of the travel range (scalar or per axis)
+    """
+
+    targets = np.atleast_2d(np.asarray(targets, dtype=float))
+    return np.all((targets >= lower) & (targets <= np.asarray(limits, dtype=float)),
+                  axis=1)
+
+
+def outside_keepout(targets, keepout):
+    """ Returns a boolean array: True for targets outside all keep-out zones.
+        -- keepout: boxes as array (n_boxes, 2, n_axes) of lower and upper
+           corners; nan in a corner leaves that axis unbounded
+    """
+
+    targets = np.atleast_2d(np.asarray(targets, dtype=float))
+    boxes = np.asarray(keepout, dtype=float).reshape(-1, 2, targets.shape[1])
+    if len(boxes) == 0:
+        return np.ones(len(targets), dtype=bool)
+
+    lower = np.where(np.isnan(boxes[:, 0]), -np.inf, boxes[:, 0])
+    upper = np.where(np.isnan(boxes[:, 1]), np.inf, boxes[:, 1])
+
+    # (n_targets, n_boxes, n_axes): inside a box means inside on every axis
+    inside = (targets[:, None, :] > lower) & (targets[:, None, :] < upper)
+    return ~np.any(np.all(inside, axis=2), axis=1)
+
+
+def check_targets(targets, limits, keepout=(), lower=0.):
+    "returns a boolean array: True for targets that may be approached"
+    return within_range(targets, limits, lower) & outside_keepout(targets, keepout)
@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for the ASCII protocol of the OWIS PS10 motor controllers.
+
+Every command and every reply on the bus is terminated with CR LF, e.g.
+  01PSET1=100000\r\n  -> move target of axis 1 on slave 01
+  01?CNT1\r\n         -> query position counter of axis 1 on slave 01
+"""
+
+import collections
+import configparser
+import contextlib
+import hashlib
+import queue
+import re
+import threading
+import time
+
+import numpy as np
+import serial
+
+# make the PS10 simulator available as ps10sim:// port
+# (see Backend/PS10Sim.py and Backend/protocol_ps10sim.py)
+if 'Backend' not in serial.protocol_handler_packages:
+    serial.protocol_handler_packages.append('Backend')
+
+
+TERMINATOR = b'\r\n'
+
+# motor parameters written from the [MOTOR] section of owis.ini
+# (SMK is deliberately written twice)
+CONFIG_PARAMETERS = ['SMK', 'SMK', 'SPL', 'RMK', 'RPL', 'RVELF', 'RVELS',
+                     'ACC', 'PVEL', 'FVEL', 'PHINTIM', 'MCSTP', 'DRICUR',
+                     'HOLCUR', 'ATOT', 'MOTYPE', 'MAXOUT', 'AMPSHNT',
+                     'AMPPWMF']
+
+# commands that start a motion (cached positions become invalid)
+MOTION_COMMANDS = ['PGO', 'REF', 'INIT', 'STOP']
+
+# serial rates tried when the link is set up, and the command that switches
+# a controller to another rate (it answers at the old rate, then switches)
+BAUD_RATES = [9600, 19200, 38400, 57600, 115200]
+BAUD_COMMAND = 'BAUDRATE'
+
+# axis states (?ASTAT) while an axis is busy: positioning with trapezoidal
+# (T) or S-curve (S) profile, velocity mode (V), reference run (P), freeing a
+# limit switch (F, e.g. during the reference run), joystick mode (J), phase
+# initialisation (H), trajectory (W) and contouring mode (X). 'R' is ready,
+# 'I' not initialised, the others (O, L, B, A, M, Z, U, E) are errors.
+MOTION_STATES = 'TSVPFJHWX'
+REFERENCE_STATE = 'P'
+
+
+def format_command(slaveID, nAxis, command, value=''):
+    """ Returns the encoded set command for the given slave and axis. """
+
+    if value == '':
+        command = "{:02d}{:s}{:d}\r\n".format(slaveID, command, nAxis)
+    else:
+        command = ("{:02d}{:s}{:d}={:s}\r\n"
+                   .format(slaveID, command, nAxis, str(value)))
+
+    return command.encode(encoding="ASCII")
+
+
+# shape of the replies to queries that are checked before a reply is taken
+# as answer (bare replies are matched by bus order only)
+NUMBER = re.compile(r'^-?\d+$')
+REPLY_SHAPES = dict({key: NUMBER for key in CONFIG_PARAMETERS},
+                    CNT=NUMBER, PSET=NUMBER, ASTAT=re.compile(r'^[A-Z]$'))
+
+
+def reply_fits(data, reply):
+    "returns False if reply cannot be the answer to the encoded command data"
+
+    m = re.match(rb'^\d\d\?([A-Z]+)\d', data)
+    if m is None:
+        return True  # set commands: any acknowledgement
+    shape = REPLY_SHAPES.get(m.group(1).decode())
+    return shape is None or shape.match(reply) is not None
+
+
+def format_query(slaveID, nAxis, request):
+    """ Returns the encoded query for the given slave and axis. """
+
+    request = "{:02d}?{:s}{:d}\r\n".format(slaveID, request, nAxis)
+    return request.encode(encoding="ASCII")
+
+
+def config_hash(params):
+    "returns a short fingerprint of a parameter dict"
+
+    text = ';'.join('{}={}'.format(key, params[key]) for key in sorted(params))
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def same_value(a, b):
+    "compares parameter values numerically where possible ('0010' == '10')"
+
+    try:
+        return float(a) == float(b)
+    except (TypeError, ValueError):
+        return str(a).strip() == str(b).strip()
+
+
+def move_duration(distance, vel, acc):
+    """ Returns the duration in s of a trapezoidal move.
+        -- distance: travel in motor steps
+        -- vel: positioning velocity in steps/s (PVEL)
+        -- acc: acceleration in steps/s^2 (ACC)
+    """
+
+    distance = np.abs(distance)
+    vel = np.abs(vel)
+    acc = np.abs(acc)
+
+    # distance needed to reach full speed and to brake again
+    ramps = vel**2 / acc
+
+    return np.where(distance < ramps,
+                    2. * np.sqrt(distance / acc),  # triangular profile
+                    distance / vel + vel / acc)
+
+
+def sync_velocities(distance, duration, vel, acc):
+    """ Returns per axis the velocity (steps/s) that makes a trapezoidal
+        move take the given duration, so that all axes arrive together.
+        Axes that cannot make it (or do not move) keep vel.
+        -- distance: travel of each axis in motor steps
+        -- duration: common duration in s, at least the longest move_duration
+    """
+
+    distance = np.abs(distance)
+    acc = np.abs(acc)
+
+    # duration = distance/v + v/acc, solved for the slower root
+    root = np.sqrt(np.maximum((acc * duration)**2 - 4. * acc * distance, 0.))
+    slow = (acc * duration - root) / 2.
+
+    return np.where(distance > 0, np.minimum(slow, np.abs(vel)), np.abs(vel))
+
+
+def usb_id(info):
+    "returns 'VID:PID' of a list_ports entry (None for non-USB ports)"
+
+    if info.vid is None or info.pid is None:
+        return None
+    return '{:04X}:{:04X}'.format(info.vid, info.pid)
+
+
+def is_owis_port(info, known_id=None):
+    """ Returns True if a list_ports entry belongs to an OWIS controller:
+        its USB IDs match those of the port used last time (known_id) or its
+        manufacturer/description names OWIS. """
+
+    if known_id is not None and usb_id(info) == known_id:
+        return True
+
+    text = ' '.join(str(item) for item in
+                    (info.manufacturer, info.product, info.description) if item)
+    return 'OWIS' in text.upper()
+
+
+class ReplyReader(object):
+    """ Assembles terminated reply lines from a serial port.
+
+        Reading stops as soon as the terminator arrives instead of waiting
+        for the port timeout. Bytes received after a terminator stay in the
+        buffer and are handed out with the next reply.
+    """
+
+    def __init__(self, port, terminator=TERMINATOR):
+        self.port = port
+        self.terminator = terminator
+        self.buffer = bytearray()
+        self.timed_out = False  # True if the last reply missed its deadline
+
+    def clear(self):
+        "drops all buffered bytes"
+        self.buffer = bytearray()
+
+    def flush(self):
+        "drops everything received so far (stale replies)"
+        self.port.reset_input_buffer()
+        self.clear()
+
+    def drain(self, quiet, lines=None, limit=1.):
+        """ drops everything that still arrives until the line was quiet for
+            quiet seconds or the given number of reply lines came (at most
+            limit seconds), e.g. late replies """
+
+        received = self.buffer.count(self.terminator)
+        self.clear()
+        start = last = time.monotonic()
+        while time.monotonic() - last < quiet and time.monotonic() - start < limit:
+            if lines is not None and received >= lines:
+                break
+            chunk = self.port.read(max(1, self.port.in_waiting))
+            if chunk:
+                last = time.monotonic()
+                self.buffer.extend(chunk)
+                received += self.buffer.count(self.terminator)
+                idx = self.buffer.rfind(self.terminator)
+                if idx >= 0:
+                    del self.buffer[:idx + len(self.terminator)]
+        self.clear()
+
+    def readline(self, timeout):
+        """ Returns the next reply line (without terminator) as string.
+            -- timeout: deadline in seconds for this reply. If it passes, the
+               bytes received so far are returned (empty string if none).
+        """
+
+        deadline = time.monotonic() + timeout
+        self.timed_out = False
+
+        while True:
+            idx = self.buffer.find(self.terminator)
+            if idx >= 0:
+                line = bytes(self.buffer[:idx])
+                del self.buffer[:idx + len(self.terminator)]
+                return line.decode(errors='replace')
+
+            if time.monotonic() >= deadline:
+                self.timed_out = True
+                line = bytes(self.buffer)
+                self.clear()
+                return line.decode(errors='replace')
+
+            # take everything waiting, but block for at least one byte
+            # (bounded by the port's own timeout)
+            chunk = self.port.read(max(1, self.port.in_waiting))
+            if chunk:
+                self.buffer.extend(chunk)
+
+
+class BatchMatcher(object):
+    """ Pairs the reply lines of a pipelined batch with its commands.
+
+        Replies are matched by the two-digit slave ID they start with if the
+        controllers prefix their answers (prefixed=True). Otherwise, and for
+        replies without a known prefix, the bus order is used: the oldest
+        pending command gets the next line.
+    """
+
+    def __init__(self, prefixed=False):
+        self.prefixed = prefixed
+        self.pending = []  # (index in batch, slaveID)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, index, slaveID):
+        "registers a command that awaits a reply"
+        self.pending.append((index, slaveID))
+
+    def match(self, line):
+        """ returns (index, reply) for a received line, None for a prefixed
+            line of a slave that has no command pending (stale) """
+
+        if self.prefixed and line[:2].isdigit():
+            for k, (index, slaveID) in enumerate(self.pending):
+                if slaveID == int(line[:2]):
+                    del self.pending[k]
+                    return index, line[2:]
+            return None
+
+        index, _ = self.pending.pop(0)
+        return index, line
+
+    def drop(self):
+        "gives up on the oldest pending command and returns its index"
+        index, _ = self.pending.pop(0)
+        return index
+
+    def oldest(self):
+        "returns the index of the oldest pending command"
+        return self.pending[0][0]
+
+
+class Transfer(object):
+    """ Commands of one caller for the PortOwner and, once done, their
+        replies and timing (perf_counter) for the serial hooks. """
+
+    def __init__(self, commands, window, timeout):
+        self.commands = commands  # (slaveID, encoded command, expects reply)
+        self.window = window
+        self.timeout = timeout
+
+        self.replies = [''] * len(commands)
+        self.deadlines = [timeout] * len(commands)  # per reply in s
+        self.sent = [(0, 0.)] * len(commands)  # bytes, time
+        self.received = [None] * len(commands)  # (time, timed out)
+        self.requested = time.perf_counter()
+
+        self.written = 0  # commands on the wire
+        self.waiting = 0  # replies still to come
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, error=None):
+        self.error = error
+        self.done.set()
+
+
+class PortOwner(object):
+    """ Owns the serial port of a MotorControl (link.ctrl, link.reader, ...):
+        one I/O thread does all the traffic. Callers on any thread hand over
+        their commands and get their own replies back. Commands of
+        different callers are pipelined like one batch (each transfer up to
+        its own window, all together up to link.batch_window) if the replies
+        carry the slave ID; bare replies are matched by bus order
+        (BatchMatcher), so then only the commands of one caller are in
+        flight at a time. A missed deadline or a reply that does not fit its
+        query fails all commands in flight (their reply is empty).
+
+        exclusive() lends the port to the calling thread for things that
+        are not request/reply (opening, scanning the bus).
+    """
+
+    def __init__(self, link):
+        self.link = link
+        self.jobs = queue.Queue()
+        self.holder = None  # thread that has the port through exclusive()
+        self.unanswered = 0  # commands sent since the last one with reply
+        self.thread = threading.Thread(target=self.run, name='PS10 I/O',
+                                       daemon=True)
+        self.thread.start()
+
+    def exchange(self, commands, window=1, timeout=0.05):
+        """ sends commands [(slaveID, encoded command, expects reply)] and
+            returns the finished Transfer; port errors are raised here """
+
+        transfer = Transfer(commands, window, timeout)
+        current = threading.current_thread()
+
+        if not commands:
+            transfer.finish()
+        elif current is self.thread or current is self.holder:
+            self.transfer_now(transfer)
+        else:
+            self.jobs.put(transfer)
+            transfer.done.wait()
+
+        if transfer.error is not None:
+            raise transfer.error
+        return transfer
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        "waits until the I/O thread is idle and hands the port to the caller"
+
+        if threading.current_thread() in (self.thread, self.holder):
+            yield
+            return
+
+        granted, released = threading.Event(), threading.Event()
+        self.jobs.put((granted, released))
+        granted.wait()
+        self.holder = threading.current_thread()
+        try:
+            yield
+        finally:
+            self.holder = None
+            released.set()
+
+    def transfer_now(self, transfer):
+        "runs one transfer on the calling thread (port already owned)"
+
+        matcher = BatchMatcher(self.link.prefixed_replies)
+        try:
+            while transfer.written < len(transfer.commands):
+                self.write_next(transfer, matcher)
+                while len(matcher) >= max(1, transfer.window):
+                    self.read_next(matcher)
+            while len(matcher):
+                self.read_next(matcher)
+        except (serial.SerialException, OSError) as e:
+            transfer.finish(e)
+            return
+        transfer.finish()
+
+    def run(self):
+        writing = collections.deque()  # transfers not completely written
+        matcher = BatchMatcher(self.link.prefixed_replies)
+
+        while True:
+            if not len(matcher):
+                matcher.prefixed = self.link.prefixed_replies
+
+            # block for new work only while nothing is in flight
+            try:
+                job = self.jobs.get(block=not (writing or len(matcher)))
+            except queue.Empty:
+                job = None
+            if job is not None:
+                writing.append(job)
+
+            try:
+                if writing and isinstance(writing[0], tuple):
+                    # exclusive(): wait until all replies are in, then lend
+                    if len(matcher):
+                        self.read_next(matcher)
+                        continue
+                    granted, released = writing.popleft()
+                    granted.set()
+                    released.wait()
+                    matcher = BatchMatcher(self.link.prefixed_replies)
+                elif writing and writing[0].waiting < max(1, writing[0].window) \
+                        and len(matcher) < max(1, self.link.batch_window) \
+                        and (matcher.prefixed or writing[0].written or not len(matcher)):
+                    transfer = writing[0]
+                    self.write_next(transfer, matcher)
+                    if transfer.written == len(transfer.commands):
+                        writing.popleft()
+                        if transfer.waiting == 0:
+                            transfer.finish()
+                elif len(matcher):
+                    self.read_next(matcher)
+            except Exception as e:
+                # fail everything in flight, the callers see the error
+                failed = {id(t): t for t in writing if not isinstance(t, tuple)}
+                for index, _ in matcher.pending:
+                    failed[id(index[0])] = index[0]
+                for transfer in failed.values():
+                    transfer.finish(e)
+                writing = collections.deque(t for t in writing if isinstance(t, tuple))
+                matcher = BatchMatcher(self.link.prefixed_replies)
+
+    def write_next(self, transfer, matcher):
+        "writes the next command of a transfer"
+
+        i = transfer.written
+        slaveID, data, expects_reply = transfer.commands[i]
+        if not len(matcher):
+            # nothing in flight: whatever is in the input is stale
+            self.link.reader.flush()
+        self.link.ctrl.write(data)
+        transfer.sent[i] = (len(data), time.perf_counter())
+        transfer.written += 1
+
+        if expects_reply:
+            # the controllers work off the unanswered commands first
+            transfer.deadlines[i] = transfer.timeout * (1 + self.unanswered)
+            self.unanswered = 0
+            transfer.waiting += 1
+            matcher.add((transfer, i), slaveID)
+        else:
+            self.unanswered += 1
+
+    def read_next(self, matcher):
+        "reads one reply line and hands it to its transfer"
+
+        transfer, i = matcher.oldest()
+        asw = self.link.reader.readline(transfer.deadlines[i])
+        if self.link.reader.timed_out:
+            # no (complete) reply within deadline, it may still come
+            self.resync(matcher, len(matcher))
+            return
+
+        matched = matcher.match(asw)
+        if matched is None:
+            return  # late reply of an earlier command
+        (transfer, i), asw = matched
+        if not reply_fits(transfer.commands[i][1], asw):
+            self.deliver(transfer, i, '', True)  # belongs to another command
+            self.resync(matcher, len(matcher) + 1)
+            return
+        self.deliver(transfer, i, asw, False)
+
+    def resync(self, matcher, lines):
+        """ fails all commands in flight after the bus order got lost and
+            drops the lines replies that are still to come, so that none of
+            them is taken for the reply to a later command. The wait is
+            bounded by the deadlines of the failed commands: a reply that
+            never comes (e.g. of a slave that is not there) costs one more
+            deadline. """
+
+        # the controllers answer in order but may still work off a backlog,
+        # so a quiet line does not mean that nothing is owed any more
+        limit = sum(t.deadlines[i] for (t, i), _ in matcher.pending)
+        self.link.reader.drain(limit, lines, limit)
+        while len(matcher):
+            transfer, i = matcher.drop()
+            self.deliver(transfer, i, '', True)
+
+    def deliver(self, transfer, i, asw, timed_out):
+        "hands reply i to its transfer"
+
+        transfer.replies[i] = asw
+        transfer.received[i] = (time.perf_counter(), timed_out)
+        transfer.waiting -= 1
+        if transfer.waiting == 0 and transfer.written == len(transfer.commands):
+            transfer.finish()
+
+
+class LinkCache(object):
+    """ Remembers facts about the serial link (slave IDs, ...) between
+        program starts in a small .ini file. The facts of a bus are stored
+        in the section of its port (e.g. [COM3], [ps10sim://]), so another
+        port never overwrites them; [PORT] names the last port that worked.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.config = configparser.RawConfigParser()
+        self.config.read(filename)
+
+    def get(self, section, key, fallback=None):
+        return self.config.get(section, key, fallback=fallback)
+
+    def get_list(self, section, key):
+        "returns a comma separated entry as list of ints"
+        value = self.get(section, key)
+        if not value:
+            return []
+        return [int(item) for item in value.split(',')]
+
+    def set(self, section, key, value):
+        "stores a value (lists are joined by commas) and writes the file"
+
+        if isinstance(value, (list, tuple)):
+            value = ','.join(str(item) for item in value)
+
+        if not self.config.has_section(section):
+            self.config.add_section(section)
+        self.config.set(section, key, str(value))
+
+        try:
+            with open(self.filename, 'w') as f:
+                self.config.write(f)
+        except OSError:
+            pass
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated bus of OWIS PS10 controllers, to run and benchmark MotorControl
+without the stages.
+
+The simulator is opened like any pyserial port by its URL:
+  ps10sim://?slaves=1,2,3&latency=0.002&jitter=0.001
+
+URL options:
+  slaves    slave IDs present on the bus (default 1,2,3)
+  latency   processing time of the controller per command in s
+  jitter    additional random delay per command, uniform in [0, jitter] s
+  speedup   factor by which motions run faster than real time
+  ack       1: set commands are answered with OK, 0: not answered (default)
+  prefix    1: replies start with the slave ID
+  baud      serial rate the controllers start with (default 9600), commands
+            sent at another rate are not understood
+  seed      seed of the random generator for the jitter
+  ini       parameter file the axes start with (default Backend/owis.ini)
+
+Velocities (PVEL, RVELF) are taken as steps/s and ACC as steps/s^2.
+"""
+
+import collections
+import configparser
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse as urlparse
+
+from serial.serialutil import SerialBase, SerialException, PortNotOpenError
+
+from Backend.PS10 import BAUD_COMMAND, BAUD_RATES, move_duration
+
+
+COMMAND = re.compile(r'^(\d\d)(\?)?([A-Z]+)(\d)(?:=(.*))?$')
+
+
+class SimAxis(object):
+    """ One simulated PS10 slave driving a single linear axis. """
+
+    def __init__(self, params, speedup=1.):
+        self.params = dict(params)
+        self.speedup = speedup
+
+        self.state = 'I'  # not initialized
+        self.baudrate = 9600
+        self.absolute = True
+        self.pset = 0.
+
+        # current move: start, end (steps), start time, duration (s)
+        self.start = 0.
+        self.end = 0.
+        self.t0 = 0.
+        self.duration = 0.
+        self.vel = 1.
+        self.acc = 1.
+
+    def param(self, key, default):
+        try:
+            return float(self.params[key])
+        except (KeyError, ValueError):
+            return default
+
+    def position(self):
+        "returns the current position in steps and finishes ended moves"
+
+        if self.state not in 'TP':
+            return self.end
+
+        t = (time.monotonic() - self.t0) * self.speedup
+        if t >= self.duration:
+            self.state = 'R'
+            return self.end
+
+        # trapezoidal profile, ramps are cut short on short moves
+        ramp = min(self.vel / self.acc, self.duration / 2.)
+        vmax = self.acc * ramp
+        if t < ramp:
+            s = 0.5 * self.acc * t**2
+        elif t < self.duration - ramp:
+            s = 0.5 * self.acc * ramp**2 + vmax * (t - ramp)
+        else:
+            s = abs(self.end - self.start) - 0.5 * self.acc * (self.duration - t)**2
+
+        return self.start + s * (1 if self.end >= self.start else -1)
+
+    def move(self, end, vel, acc, state='T'):
+        "starts a move to end (steps)"
+
+        self.start = self.position()
+        self.end = float(end)
+        self.vel = max(abs(vel), 1.)
+        self.acc = max(abs(acc), 1.)
+        self.duration = float(move_duration(self.end - self.start,
+                                            self.vel, self.acc))
+        self.t0 = time.monotonic()
+        self.state = state
+
+    def stop(self):
+        self.end = self.position()
+        self.state = 'R'
+
+    def query(self, key):
+        "returns the answer to ?key (None for unknown keys)"
+
+        if key == 'CNT':
+            return '{:d}'.format(int(round(self.position())))
+        if key == 'ASTAT':
+            self.position()
+            return self.state
+        if key == 'PSET':
+            return '{:d}'.format(int(self.pset))
+        return self.params.get(key)
+
+    def command(self, key, value):
+        "executes a set command, returns False if the command is unknown"
+
+        if key == 'INIT':
+            if self.state == 'I':
+                self.state = 'R'
+        elif key == 'ABSOL':
+            self.absolute = True
+        elif key == 'RELAT':
+            self.absolute = False
+        elif key == 'PSET':
+            self.pset = float(value)
+        elif key == 'PGO':
+            if self.state == 'R':
+                end = self.pset if self.absolute else self.end + self.pset
+                self.move(end, self.param('PVEL', 25000.),
+                          self.param('ACC', 500000.))
+        elif key == 'REF':
+            if self.state == 'R':
+                self.move(0., self.param('RVELF', 25000.),
+                          self.param('ACC', 500000.), state='P')
+        elif key == 'STOP':
+            self.stop()
+        elif key == 'CNT':
+            self.stop()
+            self.end = float(value)
+        elif key == BAUD_COMMAND:
+            if value is None or int(value) not in BAUD_RATES:
+                return False
+        elif value is not None:
+            self.params[key] = value
+        else:
+            return False
+        return True
+
+
+class PS10Bus(object):
+    """ All simulated slaves behind one serial port. """
+
+    def __init__(self, slaves=(1, 2, 3), params=None, speedup=1.,
+                 ack=False, prefix=False, baudrate=9600):
+        self.axes = {ID: SimAxis(params or {}, speedup) for ID in slaves}
+        for axis in self.axes.values():
+            axis.baudrate = baudrate
+        self.ack = ack
+        self.prefix = prefix
+
+    def handle(self, line, baudrate=9600):
+        """returns the reply to one command line (None if nothing is sent back)
+            -- baudrate: rate the line was sent at"""
+
+        m = COMMAND.match(line)
+        if m is None:
+            return None
+
+        slaveID, query, key, _, value = m.groups()
+        axis = self.axes.get(int(slaveID))
+        if axis is None or axis.baudrate != baudrate:
+            return None  # nobody listens at this ID (or at this rate)
+
+        if query:
+            asw = axis.query(key)
+        else:
+            done = axis.command(key, value)
+            asw = 'OK' if done and self.ack else None
+            if done and key == BAUD_COMMAND:
+                axis.baudrate = int(value)  # after the reply
+
+        if asw is not None and self.prefix:
+            asw = slaveID + asw
+        return asw
+
+
+def load_params(filename):
+    "returns the [MOTOR] section of an owis.ini file as dict"
+
+    config = configparser.RawConfigParser()
+    config.optionxform = str  # keep upper case keys
+    config.read(filename)
+
+    if not config.has_section('MOTOR'):
+        return {}
+    return dict(config.items('MOTOR'))
+
+
+class Serial(SerialBase):
+    """ pyserial port connected to a simulated PS10 bus. Replies become
+        readable after the wire time of command and reply at the set
+        baudrate plus the controller latency and jitter. """
+
+    def __init__(self, *args, **kwargs):
+        self.bus = None
+        self.latency = 0.
+        self.jitter = 0.
+        self.random = random.Random()
+
+        self._rx = bytearray()  # bytes readable by the host
+        self._tx = bytearray()  # bytes of an incomplete command
+        self._pending = collections.deque()  # (time readable, bytes)
+        self._busy_until = 0.
+        self._lock = threading.Condition()
+
+        super(Serial, self).__init__(*args, **kwargs)
+
+    def open(self):
+        if self.is_open:
+            raise SerialException("Port is already open.")
+        if self._port is None:
+            raise SerialException("Port must be configured before it can be used.")
+
+        self.from_url(self.port)
+        self._reconfigure_port()
+        self.is_open = True
+        self.reset_input_buffer()
+
+    def from_url(self, url):
+        "builds the bus from the URL options"
+
+        parts = urlparse.urlsplit(url)
+        if parts.scheme != 'ps10sim':
+            raise SerialException('expected a string in the form '
+                                  '"ps10sim://[?option=value...]": not starting '
+                                  'with ps10sim:// ({!r})'.format(parts.scheme))
+
+        options = {key: values[0] for key, values
+                   in urlparse.parse_qs(parts.query, True).items()}
+        try:
+            slaves = [int(ID) for ID in options.pop('slaves', '1,2,3').split(',')]
+            self.latency = float(options.pop('latency', 0.002))
+            self.jitter = float(options.pop('jitter', 0.))
+            speedup = float(options.pop('speedup', 1.))
+            ack = options.pop('ack', '0') == '1'
+            prefix = options.pop('prefix', '0') == '1'
+            baud = int(options.pop('baud', 9600))
+            if 'seed' in options:
+                self.random.seed(int(options.pop('seed')))
+            ini = options.pop('ini', os.path.join(os.path.dirname(__file__),
+                                                  'owis.ini'))
+            if options:
+                raise ValueError('unknown option: {!r}'.format(list(options)[0]))
+        except ValueError as e:
+            raise SerialException('invalid ps10sim:// URL: {}'.format(e))
+
+        self.bus = PS10Bus(slaves, load_params(ini), speedup, ack, prefix, baud)
+
+    def _reconfigure_port(self):
+        if not 0 < self._baudrate < 2 ** 32:
+            raise ValueError("invalid baudrate: {!r}".format(self._baudrate))
+
+    def close(self):
+        self.is_open = False
+        super(Serial, self).close()
+
+    def _wire_time(self, nbytes):
+        return 10. * nbytes / self._baudrate
+
+    def _release(self):
+        "moves replies whose time has come to the input buffer"
+
+        now = time.monotonic()
+        while self._pending and self._pending[0][0] <= now:
+            self._rx.extend(self._pending.popleft()[1])
+
+    @property
+    def in_waiting(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        with self._lock:
+            self._release()
+            return len(self._rx)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise PortNotOpenError()
+
+        deadline = None if self._timeout is None else time.monotonic() + self._timeout
+
+        with self._lock:
+            while True:
+                self._release()
+                if len(self._rx) >= size:
+                    break
+
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    break
+
+                # sleep until the next reply arrives or the timeout is over
+                wake = self._pending[0][0] if self._pending else None
+                if deadline is not None:
+                    wake = deadline if wake is None else min(wake, deadline)
+                self._lock.wait(None if wake is None else max(0., wake - now))
+
+            data = bytes(self._rx[:size])
+            del self._rx[:size]
+        return data
+
+    def write(self, data):
+        if not self.is_open:
+            raise PortNotOpenError()
+
+        with self._lock:
+            self._tx.extend(data)
+            while b'\r\n' in self._tx:
+                idx = self._tx.find(b'\r\n')
+                line = bytes(self._tx[:idx]).decode(errors='replace')
+                del self._tx[:idx + 2]
+                self._execute(line)
+            self._lock.notify_all()
+
+        return len(data)
+
+    def _execute(self, line):
+        "runs one command on the bus and schedules its reply"
+
+        # the controllers work off the commands one after the other
+        start = max(time.monotonic(), self._busy_until)
+        done = start + self._wire_time(len(line) + 2) + self.latency
+        if self.jitter:
+            done += self.random.uniform(0., self.jitter)
+
+        asw = self.bus.handle(line, self._baudrate)
+        if asw is not None:
+            done += self._wire_time(len(asw) + 2)
+            self._pending.append((done, (asw + '\r\n').encode()))
+        self._busy_until = done
+
+    def reset_input_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+        with self._lock:
+            self._release()
+            self._rx = bytearray()
+
+    def reset_output_buffer(self):
+        if not self.is_open:
+            raise PortNotOpenError()
+
+    def _update_break_state(self):
+        pass
+
+    def _update_rts_state(self):
+        pass
+
+    def _update_dtr_state(self):
+        pass
+
+    @property
+    def cts(self):
+        return True
+
+    @property
+    def dsr(self):
+        return True
+
+    @property
+    def ri(self):
+        return False
+
+    @property
+    def cd(self):
+        return True
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the float type of the Lynx analysis does not change its results.
+
+Analyses a Lynx DICOM in float32 and in float64 the way the GUI does
+(autodetected field, get_characteristicData) plus eval2DFlatness, and
+compares W50, W90, flatness, plateau tilt, the correction of the second
+scatterer and the pass rate against tolerances. Run from the ScattERR
+directory:
+
+    python -m Backend.PrecisionCheck ExponatO_Lynx_1nA5_02_i.dcm
+
+The exit code is 1 if a value differs by more than its tolerance.
+"""
+
+import argparse
+import contextlib
+import io
+import sys
+
+import numpy as np
+
+# allowed absolute difference between float32 and float64
+TOLERANCES = {"W50": 0.01,  # mm
+              "W90": 0.01,  # mm
+              "flatness": 1e-3,
+              "flatnessCorr": 1e-3,
+              "plateauTilt": 1e-3,
+              "correction": 0.01,  # mm
+              "passRate": 1e-3,  # 40 of 40000 pixels
+              "theta": 1e-3,  # degrees
+              }
+
+
+def analyse(filename, dtype):
+    "returns the characteristic values of one DICOM analysed in dtype"
+
+    from Backend.lynxReaderMalte import Lynx
+
+    lynx = Lynx(filename, dtype=dtype)
+    with contextlib.redirect_stdout(io.StringIO()):  # the analysis talks a lot
+        lynx.autodetectRectField()
+        correction = lynx.get_characteristicData(None, plot=False)
+        _, _, passRate, theta, _ = lynx.eval2DFlatness()
+
+    values = {"correction": correction, "passRate": [passRate], "theta": [theta]}
+    for column, name in [(3, "W50"), (4, "W90"), (5, "flatness"),
+                         (6, "flatnessCorr"), (7, "plateauTilt")]:
+        values[name] = [row[column] for row in lynx.characteristics]  # x, y
+    return values
+
+
+def compare(single, double, tolerances=TOLERANCES):
+    "prints both results side by side, returns the names out of tolerance"
+
+    failed = []
+    print("{0:14s} {1:>14s} {2:>14s} {3:>10s} {4:>10s}"
+          .format("value", "float32", "float64", "diff", "tolerance"))
+    for name, tolerance in tolerances.items():
+        for a, b in zip(single[name], double[name]):
+            diff = abs(float(a) - float(b))
+            print("{0:14s} {1:14.6f} {2:14.6f} {3:10.2e} {4:10.1e}{5:s}"
+                  .format(name, a, b, diff, tolerance,
+                          "" if diff <= tolerance else "  FAILED"))
+            if diff > tolerance and name not in failed:
+                failed.append(name)
+    return failed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare the Lynx analysis in float32 and float64")
+    parser.add_argument("filename", nargs="?", default="ExponatO_Lynx_1nA5_02_i.dcm",
+                        help="Lynx DICOM file (default: the example of the repository)")
+    args = parser.parse_args()
+
+    failed = compare(analyse(args.filename, np.float32),
+                     analyse(args.filename, np.float64))
+    if failed:
+        print("ERR: float32 results out of tolerance: {0:s}".format(", ".join(failed)))
+        sys.exit(1)
+    print("float32 results within tolerance")
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Scan mode for the second scatterer with the measurement in the loop.
+
+ScatterScan moves scatterer 2 through an optional grid and then towards the
+estimated optimum. After every move it waits for the next Lynx DICOM in a
+watched folder, evaluates it (in a worker thread, the GUI stays responsive)
+and updates the estimate. Every exposure
+refines the estimate, so the field gets flat in fewer exposures than by
+repeating load image + adjust.
+
+Positions are (x, y) of scatterer 2 in mm (axes 0 and 2 of the table),
+corrections are those of Lynx.get_characteristicData.
+"""
+
+import collections
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PyQt5.QtCore import QObject, QFileSystemWatcher, QTimer, pyqtSignal
+
+
+def analyse_lynx(filename):
+    "returns the correction (x, y) in mm of scatterer 2 from one Lynx DICOM"
+
+    from Backend.lynxReaderMalte import Lynx
+
+    lynx = Lynx(filename)
+    if not lynx.dataOK:
+        raise ValueError('could not read {0:s}'.format(filename))
+    lynx.autodetectRectField()
+    return np.array(lynx.get_characteristicData(None, plot=False), dtype=float)
+
+
+class CorrectionEstimate(object):
+    """ Running least squares fit of correction = c0 + c1*position per axis.
+        The slope is pulled towards -1 (the correction model is right), so a
+        single exposure already gives position + correction, and every
+        further exposure corrects the gain of the model. """
+
+    def __init__(self, prior_weight=0.1):
+        self.prior_weight = prior_weight  # mm^2, weight of the prior slope
+        self.n = 0
+        self.sp = np.zeros(2)
+        self.spp = np.zeros(2)
+        self.sc = np.zeros(2)
+        self.scp = np.zeros(2)
+        self.last = None  # (position, correction)
+
+    def add(self, position, correction):
+        p = np.asarray(position, dtype=float)
+        c = np.asarray(correction, dtype=float)
+
+        self.n += 1
+        self.sp += p
+        self.spp += p * p
+        self.sc += c
+        self.scp += c * p
+        self.last = (p, c)
+
+    def coefficients(self):
+        "returns c0, c1 per axis"
+
+        mean_p = self.sp / self.n
+        mean_c = self.sc / self.n
+        var_p = self.spp - self.n * mean_p**2
+        cov = self.scp - self.n * mean_p * mean_c
+
+        c1 = (cov - self.prior_weight) / (var_p + self.prior_weight)
+        c0 = mean_c - c1 * mean_p
+        return c0, c1
+
+    def optimum(self):
+        "returns the position where the correction is expected to vanish"
+
+        if self.n == 0:
+            return None
+        p, c = self.last
+        c0, c1 = self.coefficients()
+
+        # an axis whose fit does not point back to a minimum follows the model
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fitted = -c0 / c1
+        return np.where(c1 < 0, fitted, p + c)
+
+
+class ScatterScan(QObject):
+    """ Drives the scan: moves scatterer 2 through the motion queue and
+        evaluates every new .dcm file in folder.
+        -- queue: MotionQueue of the table
+        -- grid: (x, y) positions in mm visited first (may be empty)
+        -- tolerance: done when both corrections are below it (mm)
+        -- max_exposures: give up after that many images
+        -- settle: s a new file has to keep its size before it is read
+    """
+
+    measured = pyqtSignal(object, object)  # position, correction
+    moving = pyqtSignal(object)  # next position
+    finished = pyqtSignal(object, bool)  # best position, converged
+    analysed = pyqtSignal(str, object, object)  # file, position, correction or error
+
+    def __init__(self, queue, folder, grid=(), tolerance=0.05,
+                 max_exposures=10, settle=0.5, analyse=analyse_lynx):
+        super().__init__()
+
+        self.queue = queue
+        self.folder = folder
+        self.grid = collections.deque(np.asarray(grid, dtype=float).reshape(-1, 2))
+        self.tolerance = tolerance
+        self.max_exposures = max_exposures
+        self.settle = settle
+        self.analyse = analyse
+
+        self.estimate = CorrectionEstimate()
+        self.position = None
+        self.exposures = 0
+        self.running = False
+
+        self.seen = set()
+        self.sizes = {}  # new files -> size at the last look
+        self.watcher = QFileSystemWatcher()
+        self.watcher.directoryChanged.connect(self.look)
+
+        # one thread: exposures are evaluated in the order they came in
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.analysed.connect(self.evaluate)
+
+    def dicom_files(self):
+        return {os.path.join(self.folder, name) for name in os.listdir(self.folder)
+                if name.lower().endswith('.dcm')}
+
+    def start(self):
+        "starts watching the folder, images already there are ignored"
+
+        planned = self.queue.planned()
+        self.position = np.array([planned[0], planned[2]])
+        self.seen = self.dicom_files()
+        self.watcher.addPath(self.folder)
+        self.running = True
+
+        logging.info('Scan of 2nd scatterer started, watching {0:s}'.format(self.folder))
+        if self.grid:
+            self.move(self.grid.popleft())
+
+    def stop(self, converged=False):
+        if not self.running:
+            return
+        self.running = False
+        self.watcher.removePath(self.folder)
+        self.finished.emit(self.position, converged)
+
+    def look(self, *args):
+        "checks the folder for new images that are completely written"
+
+        if not self.running:
+            return
+
+        for filename in sorted(self.dicom_files() - self.seen):
+            size = os.path.getsize(filename)
+            if size == 0 or self.sizes.get(filename) != size:
+                self.sizes[filename] = size  # still growing, look again later
+                QTimer.singleShot(int(1e3 * self.settle), self.look)
+                continue
+
+            self.seen.add(filename)
+            del self.sizes[filename]
+            self.ingest(filename)
+
+    def ingest(self, filename):
+        "hands one exposure taken at the current position to the analysis"
+
+        if not self.queue.idle():
+            logging.warning('{0:s} was taken while the scatterer moved, '
+                            'ignored'.format(os.path.basename(filename)))
+            return
+
+        self.executor.submit(self.run_analysis, filename, self.position.copy())
+
+    def run_analysis(self, filename, position):
+        "runs in the worker thread, the result goes to evaluate"
+
+        try:
+            result = self.analyse(filename)
+        except (ValueError, IndexError, OSError) as e:
+            result = e
+        self.analysed.emit(filename, position, result)
+
+    def evaluate(self, filename, position, correction):
+        "updates the estimate with one exposure and decides the next move"
+
+        if not self.running:
+            return
+        if isinstance(correction, Exception):
+            logging.error('Could not evaluate {0:s}'.format(filename),
+                          exc_info=correction)
+            return
+
+        self.exposures += 1
+        self.estimate.add(position, correction)
+        self.measured.emit(position, correction)
+        logging.info('Scan exposure {0:d} at x_s2 = {1:.2f} mm, y_s2 = {2:.2f} mm: '
+                     'correction dx = {3:.3f} mm, dy = {4:.3f} mm'.format(
+                         self.exposures, position[0], position[1],
+                         correction[0], correction[1]))
+
+        if not np.array_equal(position, self.position):
+            return  # moved on meanwhile, this exposure only refines the estimate
+
+        if np.all(np.abs(correction) <= self.tolerance):
+            self.stop(converged=True)
+        elif self.exposures >= self.max_exposures:
+            self.move(self.estimate.optimum())
+            self.stop()
+        elif self.grid:
+            self.move(self.grid.popleft())
+        else:
+            self.move(self.estimate.optimum())
+
+    def move(self, position):
+        "queues the move of scatterer 2 to position (x, y)"
+
+        planned = self.queue.move_to([position[0], None, position[1]])
+        if not np.allclose([planned[0], planned[2]], position):
+            self.stop()  # rejected by the limits
+            return
+
+        self.position = np.asarray(position, dtype=float)
+        self.moving.emit(self.position)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Tracing of the serial traffic of MotorControl.
+
+MotorControl calls every function in its list `hooks` once per command
+with an event dict:
+  command     command name, queries start with '?'
+  slave       slave ID
+  sent        bytes sent
+  received    bytes received (0 if no reply came)
+  start       time.perf_counter() when the command went out
+  queue_wait  time in s the command waited for the port
+  wire        time in s from sending until the reply was complete
+  timeout     True if the reply did not come within its deadline
+  thread      ident of the calling thread
+
+SerialTrace is such a hook. It keeps the latest events in a ring buffer,
+counts per command and exports to JSON or the Chrome trace format
+(chrome://tracing, Perfetto):
+
+    trace = SerialTrace()
+    Motor.hooks.append(trace)
+    ...
+    print(trace.format_counters())
+    trace.to_chrome_trace('park_to_beam.json')
+"""
+
+import collections
+import json
+import threading
+
+
+class SerialTrace(object):
+    """ Records the events of the serial hooks in a ring buffer of the
+        given size and keeps running counters per command. """
+
+    def __init__(self, size=10000):
+        self.events = collections.deque(maxlen=size)
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        with self.lock:
+            self.events.append(event)
+
+            c = self.counts.setdefault(event["command"], {
+                "count": 0, "timeouts": 0, "sent": 0, "received": 0,
+                "queue_wait": 0., "wire": 0.})
+            c["count"] += 1
+            c["timeouts"] += int(event["timeout"])
+            c["sent"] += event["sent"]
+            c["received"] += event["received"]
+            c["queue_wait"] += event["queue_wait"]
+            c["wire"] += event["wire"]
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+            self.counts = {}
+
+    def counters(self):
+        "returns a copy of the counters per command"
+        with self.lock:
+            return {name: dict(c) for name, c in self.counts.items()}
+
+    def format_counters(self):
+        "returns the counters as text table (for a live view)"
+
+        lines = ["{0:10s} {1:>6s} {2:>5s} {3:>8s} {4:>8s} {5:>10s} {6:>10s}"
+                 .format("command", "count", "tout", "sent [B]", "recv [B]",
+                         "wait [ms]", "wire [ms]")]
+        for name, c in sorted(self.counters().items()):
+            lines.append("{0:10s} {1:6d} {2:5d} {3:8d} {4:8d} {5:10.2f} {6:10.2f}"
+                         .format(name, c["count"], c["timeouts"], c["sent"],
+                                 c["received"], 1e3 * c["queue_wait"] / c["count"],
+                                 1e3 * c["wire"] / c["count"]))
+        return "\n".join(lines)
+
+    def to_json(self, filename):
+        "writes all recorded events as JSON list"
+        with self.lock:
+            events = list(self.events)
+        with open(filename, "w") as f:
+            json.dump(events, f, indent=1)
+
+    def to_chrome_trace(self, filename):
+        """ writes the events in the Chrome trace event format. Commands are
+            async slices (pipelined commands overlap), grouped by the thread
+            that sent them and preceded by their wait for the port. """
+
+        with self.lock:
+            events = list(self.events)
+
+        trace = []
+        for i, e in enumerate(events):
+            name = "{0:02d}{1:s}".format(e["slave"], e["command"])
+            cat = "timeout" if e["timeout"] else "serial"
+            args = {"sent": e["sent"], "received": e["received"],
+                    "timeout": e["timeout"]}
+            common = {"name": name, "cat": cat, "id": i, "pid": 0,
+                      "tid": e["thread"]}
+
+            if e["queue_wait"] > 0:
+                trace.append({"name": "wait", "cat": "queue", "ph": "X",
+                              "ts": 1e6 * (e["start"] - e["queue_wait"]),
+                              "dur": 1e6 * e["queue_wait"],
+                              "pid": 0, "tid": e["thread"], "args": {"command": name}})
+            trace.append(dict(common, ph="b", ts=1e6 * e["start"], args=args))
+            trace.append(dict(common, ph="e", ts=1e6 * (e["start"] + e["wire"])))
+
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
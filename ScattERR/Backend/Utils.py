@@ -17,6 +17,8 @@ import numpy as np
 
 from PyQt5.QtWidgets import QMessageBox as QMessage
 
+from Backend.PS10 import ReplyReader, format_command, format_query
+
 class MotorControl(object):
     """ This class holds holds all basic functionality to control the
         motorized linear axes. """
@@ -33,6 +35,8 @@ class MotorControl(object):
         self.slaves = []
 
         self.ctrl = serial.Serial()
+        self.reader = ReplyReader(self.ctrl)
+        self.reply_timeout = 0.05  # deadline per command in s
 
         # Set default logging of serial communication to false
         self.verbose = False
@@ -300,45 +304,48 @@ class MotorControl(object):
             GUI.LabelREF.setText('Calibrated')
 
     # basic communication stuff
-    def serial_write(self, slaveID, nAxis, command, value=''):
+    def serial_write(self, slaveID, nAxis, command, value='', timeout=None):
         """ will format and send the given command through the COM port.
             -- command: serial command to be sent.
+            -- timeout: deadline for the reply in s (default: reply_timeout)
         """
 
         # write request to COM
-        if value == '':
-            command = ("{:02d}{:s}{:d}\r\n".format(slaveID, command, nAxis))
-        else:
-            command = ("{:02d}{:s}{:d}={:s}\r\n"
-                       .format(slaveID, command, nAxis, str(value)))
-
-        command = command.encode(encoding="ASCII")
+        command = format_command(slaveID, nAxis, command, value)
         if self.verbose:
             logging.debug(command)
+        self.reader.flush()  # a late reply must not be taken for this one
         self.ctrl.write(command)
 
-        # Read answer from COM and print full command  + reply
-        asw = (self.ctrl.read(1024)).decode()
+        # Read answer from COM (returns as soon as the reply is complete)
+        asw = self.reader.readline(self.reply_timeout if timeout is None
+                                   else timeout)
+        if self.reader.timed_out:
+            self.reader.drain(self.reply_timeout)
 
         return asw
 
 
-    def serial_query(self, slaveID, nAxis, request):
+    def serial_query(self, slaveID, nAxis, request, timeout=None):
         """ will format and send the given query through the COM port.
             -- command: serial command to be sent.
+            -- timeout: deadline for the reply in s (default: reply_timeout)
         """
 
         if slaveID is None or nAxis is None:
             return 0
 
         # write request to COM
-        request =  ("{:02d}?{:s}{:d}\r\n".format(slaveID, request, nAxis))
-        request = request.encode(encoding="ASCII")
+        request = format_query(slaveID, nAxis, request)
         if self.verbose: logging.debug(request)
+        self.reader.flush()  # a late reply must not be taken for this one
         self.ctrl.write(request)
 
         # Read answer from COM and return
-        asw = (self.ctrl.read(1024)).decode()
+        asw = self.reader.readline(self.reply_timeout if timeout is None
+                                   else timeout)
+        if self.reader.timed_out:
+            self.reader.drain(self.reply_timeout)
         return asw
 
 
@@ -479,6 +486,8 @@ class MotorControl(object):
         except Exception:
             logging.error('No serial connection could be openend with selected port!')
             return -1
+
+        self.reader.clear()
         
 #if __name__=="__main__":
 #    Motor = MotorControl()
@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+"""
+Background workers that talk to the motors while the GUI keeps running.
+Results are handed to the GUI thread through Qt signals only.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import numpy as np
+import serial
+from PyQt5.QtCore import QObject, QThread, Qt, pyqtSignal
+
+from Backend.PS10 import MOTION_STATES, REFERENCE_STATE, move_duration
+
+
+class Movement(QObject):
+    """ One commanded move of one or more axes. Its arrival time is
+        predicted from the move profile, so the status poller can poll
+        sparsely at first and densely near the end. The signals are the
+        hooks for whoever waits for the move. """
+
+    travelling = pyqtSignal(object)  # positions while moving
+    arrived = pyqtSignal(object)  # positions at arrival
+    timeout = pyqtSignal(object)  # positions when the deadline passed
+    error = pyqtSignal(str)  # states of the axes
+
+    def __init__(self, axes, duration, tolerance=1.5, margin=5.):
+        """ -- axes: indices of the moving axes in MotorControl.slaves
+            -- duration: predicted duration of the move in s
+            -- tolerance, margin: the move times out after
+               tolerance*duration + margin seconds
+        """
+        super().__init__()
+
+        self.axes = list(axes)
+        self.t0 = time.monotonic()
+        self.eta = self.t0 + duration
+        self.deadline = self.t0 + tolerance * duration + margin
+        self.seen_moving = False
+
+    def check(self, positions, states):
+        "emits the matching signal, returns True if the move is over"
+
+        states = [states[i] for i in self.axes]
+        now = time.monotonic()
+
+        if any(state != 'R' and state not in MOTION_STATES for state in states):
+            self.error.emit(''.join(states))
+            return True
+
+        if all(state == 'R' for state in states):
+            # right after PGO an axis may not have started yet
+            if self.seen_moving or now >= self.eta:
+                self.arrived.emit(positions)
+                return True
+        else:
+            self.seen_moving = True
+
+        if now > self.deadline:
+            self.timeout.emit(positions)
+            return True
+
+        self.travelling.emit(positions)
+        return False
+
+
+class ReferenceRun(Movement):
+    """ Reference runs of several axes started together. Like a Movement,
+        but every axis is followed on its own (like GetRefReady of the OWIS
+        library): an axis is referenced when it was seen in the reference
+        run state (not just moving) and reports ready again. """
+
+    progress = pyqtSignal(int, int)  # axes referenced, axes total
+
+    def __init__(self, axes, duration, tolerance=1.5, margin=10.):
+        super().__init__(axes, duration, tolerance, margin)
+
+        self.referenced = set()
+        self.seen_axes = set()
+
+    def check(self, positions, states):
+        "emits the matching signal, returns True if all axes are referenced"
+
+        now = time.monotonic()
+
+        for i in self.axes:
+            if states[i] == REFERENCE_STATE:
+                self.seen_axes.add(i)
+            elif states[i] in MOTION_STATES:
+                pass  # e.g. freeing the limit switch at the end of the run
+            elif states[i] != 'R':
+                self.error.emit(''.join(states[j] for j in self.axes))
+                return True
+            elif i not in self.referenced and (i in self.seen_axes or now >= self.eta):
+                self.referenced.add(i)
+                self.progress.emit(len(self.referenced), len(self.axes))
+
+        if len(self.referenced) == len(self.axes):
+            self.arrived.emit(positions)
+            return True
+
+        if now > self.deadline:
+            self.timeout.emit(positions)
+            return True
+
+        self.travelling.emit(positions)
+        return False
+
+
+class StatusPoller(QThread):
+    """ Single long-lived worker that polls positions and states of all
+        axes and publishes them as snapshots. It polls at fast_interval
+        while an axis is moving and at slow_interval while all are ready.
+        For tracked movements it polls every sparse_interval until
+        dense_window seconds before the predicted arrival, then at
+        fast_interval.
+    """
+
+    # positions in mm (array), states (one status character per axis)
+    status = pyqtSignal(object, object)
+
+    def __init__(self, motor, fast_interval=0.2, slow_interval=1.0,
+                 sparse_interval=2.0, dense_window=0.5):
+        super().__init__()
+
+        self.motor = motor
+        self.fast_interval = fast_interval  # s
+        self.slow_interval = slow_interval  # s
+        self.sparse_interval = sparse_interval  # s
+        self.dense_window = dense_window  # s
+
+        self.movements = []
+        self.moving = False
+        self.stopped = False
+        self.wake = threading.Event()
+
+    def run(self):
+        while not self.stopped:
+            self.poll()
+
+            self.wake.wait(self.interval())
+            self.wake.clear()
+
+    def interval(self):
+        "returns the time until the next poll"
+
+        movements = list(self.movements)
+        if movements:
+            remaining = min(m.eta for m in movements) - time.monotonic()
+            if remaining > self.dense_window:
+                return min(remaining - self.dense_window, self.sparse_interval)
+            return self.fast_interval
+
+        return self.fast_interval if self.moving else self.slow_interval
+
+    def poll(self):
+        "reads one snapshot and publishes it"
+
+        if not self.motor.ctrl.is_open or not self.motor.slaves:
+            return
+
+        try:
+            positions, states = self.motor.get_status()
+        except (ValueError, IndexError, serial.SerialException):
+            return  # incomplete answer, try again with the next tick
+
+        self.moving = any(state != 'R' for state in states)
+        self.status.emit(positions, states)
+
+        for movement in list(self.movements):
+            if movement.check(positions, states):
+                self.movements.remove(movement)
+
+    def track(self, movement):
+        "supervises a started movement until it arrives or fails"
+        self.movements.append(movement)
+        self.poke()
+
+    def poke(self):
+        "polls at once and switches to the fast rate (after motion commands)"
+        self.moving = True
+        self.wake.set()
+
+    def stop(self):
+        "ends the worker and waits for it"
+        self.stopped = True
+        self.wake.set()
+        self.wait()
+
+
+class ConnectionManager(QThread):
+    """ Keeps the serial link alive. Whenever no good reply came from the
+        axes for interval seconds, it sends a heartbeat (?ASTAT to the first
+        slave). If the port fails or misses heartbeats stay unanswered in a
+        row, the link is reopened with a growing delay between the attempts
+        (backoff) and the state of the axes is restored
+        (MotorControl.reconnect).
+    """
+
+    lost = pyqtSignal()
+    restored = pyqtSignal()
+
+    def __init__(self, motor, interval=1.0, misses=3, backoff=(0.5, 30.)):
+        super().__init__()
+
+        self.motor = motor
+        self.interval = interval  # s
+        self.misses = misses
+        self.backoff = backoff  # first and longest delay between attempts in s
+
+        self.last_reply = time.monotonic()
+        self.stopped = False
+        self.wake = threading.Event()
+
+        # every good reply of the normal traffic counts as heartbeat
+        motor.hooks.append(self.on_event)
+
+    def on_event(self, event):
+        if event["received"] and not event["timeout"]:
+            self.last_reply = time.monotonic()
+
+    def run(self):
+        while not self.stopped:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+            if self.stopped or self.alive():
+                continue
+
+            logging.error('Connection to the axes lost. Reconnecting ...')
+            self.lost.emit()
+            self.reconnect()
+
+    def alive(self):
+        "returns False if the link is dead"
+
+        if time.monotonic() - self.last_reply < self.interval:
+            return True
+        if not self.motor.slaves:
+            return True  # not connected yet, nothing to watch
+
+        for _ in range(self.misses):
+            try:
+                if self.motor.serial_query(self.motor.slaves[0], 1, 'ASTAT') != '':
+                    return True
+            except (serial.SerialException, OSError):
+                return False  # port is gone
+        return False
+
+    def reconnect(self):
+        "tries to reopen the link until it works (or the manager is stopped)"
+
+        delay = self.backoff[0]
+        while not self.stopped:
+            try:
+                if self.motor.reconnect():
+                    self.last_reply = time.monotonic()
+                    self.restored.emit()
+                    return
+            except (serial.SerialException, OSError, ValueError, IndexError):
+                pass
+
+            self.wake.wait(delay)
+            self.wake.clear()
+            delay = min(2. * delay, self.backoff[1])
+
+    def stop(self):
+        "ends the worker and waits for it"
+        self.stopped = True
+        self.wake.set()
+        self.wait()
+
+
+class MotionQueue(QThread):
+    """ Single executor for the moves requested by the GUI. Moves run one
+        after the other, never interleaved on the port. A queued target of
+        an axis is dropped when a newer request moves the same axis, and
+        stop() skips the queue. Targets are absolute positions in mm, one
+        per axis, None (or nan) keeps an axis where it is.
+
+        The status poller has to run: it decides when a move is over.
+    """
+
+    changed = pyqtSignal(int, float)  # queued moves, s until all are done
+    started = pyqtSignal(object)  # Movement of the move that starts now
+
+    def __init__(self, motor):
+        super().__init__()
+
+        self.motor = motor
+        self.pending = collections.deque()  # target arrays, nan: keep axis
+        self.current = None  # Movement in progress
+        self.active = False  # a move was taken from the queue and runs
+        self.base = None  # where the axes stand after the current move (mm)
+
+        self.stop_requested = False
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.done = threading.Event()  # current move over (or stopped)
+
+    def move_to(self, targets):
+        """ queues a move to absolute targets (mm), rejected if it leaves the
+            limits (see MotorControl.check_targets)
+            returns the planned positions of all axes after this move
+        """
+
+        targets = np.array([np.nan if t is None else t for t in targets],
+                           dtype=float)
+        moving = ~np.isnan(targets)
+
+        planned = self.planned()
+        if not self.motor.check_targets(np.where(moving, targets, planned))[0]:
+            logging.error('Target {} mm is outside the limits or in a keep-out '
+                          'zone. Move not queued.'.format(targets))
+            return planned
+
+        with self.cond:
+            for queued in self.pending:
+                queued[moving] = np.nan  # superseded by the new request
+            self.pending = collections.deque(
+                queued for queued in self.pending if not np.all(np.isnan(queued)))
+            self.pending.append(targets)
+            self.cond.notify()
+
+        self.publish()
+        return self.planned()
+
+    def move_by(self, distances):
+        """ queues a move by the given distances (mm), counted from where
+            the queued moves end. Returns the planned positions. """
+
+        distances = np.asarray(distances, dtype=float)
+        targets = self.planned() + distances
+        targets[distances == 0] = np.nan
+        return self.move_to(targets)
+
+    def stop(self):
+        "drops all queued moves and stops the axes at once"
+
+        with self.cond:
+            self.pending.clear()
+            self.stop_requested = True
+            self.cond.notify()
+        self.done.set()
+
+    def depth(self):
+        "returns the number of queued moves (without the running one)"
+        return len(self.pending)
+
+    def idle(self):
+        "returns True if no move is queued or running"
+        with self.cond:
+            return not (self.pending or self.active or self.stop_requested)
+
+    def planned(self):
+        "returns the positions (mm) of all axes after all queued moves"
+
+        with self.cond:
+            pending = [queued.copy() for queued in self.pending]
+        positions = self.start_positions()
+
+        for queued in pending:
+            positions = np.where(np.isnan(queued), positions, queued)
+        return positions
+
+    def start_positions(self):
+        "returns where the next queued move starts (mm)"
+
+        if self.base is None:
+            return np.array(self.motor.get_Position(use_cache=True), dtype=float)
+        return self.base.copy()
+
+    def eta(self):
+        "returns the time in s until all queued moves are done"
+
+        with self.cond:
+            current = self.current
+            pending = [queued.copy() for queued in self.pending]
+
+        remaining = 0.
+        if current is not None:
+            remaining = max(0., current.eta - time.monotonic())
+        if not pending:
+            return remaining
+
+        vel, acc = self.motor.motion_profile()
+        positions = self.start_positions()
+        for queued in pending:
+            targets = np.where(np.isnan(queued), positions, queued)
+            steps = np.multiply(self.motor.Step2MM, targets - positions)
+            remaining += float(np.max(move_duration(steps, vel, acc)))
+            positions = targets
+        return remaining
+
+    def publish(self):
+        "emits depth and ETA for the GUI"
+        try:
+            self.changed.emit(self.depth(), self.eta())
+        except (ValueError, IndexError, serial.SerialException):
+            pass  # positions unreadable right now, next change reports
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not (self.pending or self.stop_requested or self.stopped):
+                    self.cond.wait()
+                if self.stopped:
+                    return
+
+                if self.stop_requested:
+                    self.stop_requested = False
+                    targets = None
+                else:
+                    # from now on planned() starts at the end of this move
+                    targets = self.pending.popleft()
+                    self.active = True
+                    try:
+                        targets = np.where(np.isnan(targets),
+                                           self.start_positions(), targets)
+                    except (ValueError, IndexError, serial.SerialException):
+                        self.active = False
+                        continue
+                    self.base = targets
+
+            if targets is None:
+                self.motor.stop_axes()
+                self.base = None  # the axes stand wherever they stopped
+                self.publish()
+            else:
+                self.execute(targets)
+                with self.cond:
+                    self.active = False
+
+    def execute(self, targets):
+        "runs one move to absolute targets of all axes, waits until it is over"
+
+        self.done.clear()
+        with self.motor.lock:
+            self.motor.mode = 'absolute'
+            self.motor.moveTable(vector=targets)
+            movement, self.motor.movement = self.motor.movement, None
+        if movement is None:
+            self.base = None  # moveTable failed, positions unknown
+            return
+
+        arrived = []
+        movement.arrived.connect(lambda positions: (arrived.append(True),
+                                                    self.done.set()),
+                                 Qt.DirectConnection)
+        movement.timeout.connect(lambda positions: self.done.set(),
+                                 Qt.DirectConnection)
+        movement.error.connect(lambda states: self.done.set(),
+                               Qt.DirectConnection)
+
+        with self.cond:
+            self.current = movement
+        self.publish()
+        self.started.emit(movement)
+        self.motor.poller.track(movement)
+
+        # the poller ends the move, the deadline is only a safety net
+        self.done.wait(max(0., movement.deadline - time.monotonic()) + 1.)
+
+        with self.cond:
+            self.current = None
+            if not arrived:
+                self.base = None
+        self.publish()
+
+    def shutdown(self):
+        "ends the executor (queued moves are dropped) and waits for it"
+
+        with self.cond:
+            self.pending.clear()
+            self.stopped = True
+            self.cond.notify()
+        self.done.set()
+        self.wait()
@@ -7,9 +7,10 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import pydicom as dicom
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
 from Backend import Plot
 
-import colorsys, sys, csv,  copy,  time, os,  string,  argparse
+import colorsys, sys, csv,  time, os,  string,  argparse,  struct
 
 import logging as logg
 
@@ -17,15 +18,19 @@ import scipy.constants as cc
 from scipy import interpolate
 
 from mpl_toolkits.mplot3d import Axes3D
-from scipy import optimize
 Plot.load_defaults(2) #load before all pyplot operations 
 
 import tkinter
 from tkinter.filedialog import askopenfilename
 
+dcmread = getattr(dicom, 'dcmread', None) or dicom.read_file   # read_file before pydicom 1.0
+
 class Lynx:
-    """Central class representing the measurement from the Lynx device"""
-    def __init__(self, filename):
+    """Central class representing the measurement from the Lynx device
+        dtype: float type of the analysed data, float32 holds the detector
+               values exactly, np.float64 gives the results of old versions
+    """
+    def __init__(self, filename,  dtype = np.float32):
         
         self.filename = os.path.expanduser(filename)                 # get rid of '~' in filename
         self.path = os.path.dirname(self.filename)                   # path to data
@@ -37,7 +42,14 @@ class Lynx:
         self.comment = ""
         self.fileOK = False
         self.dataOK = False
+        self.dtype = np.dtype(dtype)
+        
         
+        self._pixels = None
+        self._data = None
+        self._roiIndices = None
+        self._cache = {}
+        self.characteristics = None
         
         self.xrange = [-np.inf,  np.inf]
         self.yrange = [-np.inf, np.inf]
@@ -64,6 +76,8 @@ class Lynx:
         if low > high:  low, high = high, low   # switch variables if provided in the wrong order
         self.xrange[0] = low
         self.xrange[1] = high
+        self._roiIndices = None
+        self._cache = {}
     
     def set_yrange(self,low, high):
         """ Set the area of interest, only rectangular ROIs are supported, 
@@ -73,6 +87,8 @@ class Lynx:
         if low > high:  low, high = high, low   # switch variables if provided in the wrong order
         self.yrange[0] = low
         self.yrange[1] = high
+        self._roiIndices = None
+        self._cache = {}
 
     def read_lynxDicom(self):
         """ Import function to actually read the dicom file, 
@@ -85,18 +101,18 @@ class Lynx:
         if not self.fileOK: 
             print ("ERR: Object not initialized (no access to file {0:s}".format(self.filename))
             return
-        self.dcmDat = dicom.read_file(self.filename)
+        # header only, the pixel data are mapped from the file on first use
+        with open(self.filename, 'rb') as f:
+            self.dcmDat = dcmread(f, stop_before_pixels=True)
+            self.pixelOffset = f.tell()
+        self._pixels = None
+        self._data = None
+        self._cache = {}
+        self._roiIndices = None      # bounds belong to the scales below
         
         self.xsc = float(self.dcmDat.RTImagePosition[0]) + np.arange(0, self.dcmDat.Rows)*float(self.dcmDat.PixelSpacing[0])
         self.ysc = float(self.dcmDat.RTImagePosition[1]) + np.arange(0, self.dcmDat.Columns)*float(self.dcmDat.PixelSpacing[1])
 
-        
-        data = self.dcmDat.pixel_array
-        data = data.astype("float")
-        
-        data = np.fliplr(data)
-        self.data = data
-        
         print ("Importet a matrix of {0:d}x{1:d} from {2:s}".format(self.dcmDat.Rows,self.dcmDat.Columns,  self.filename  ))
         
         self.metaData_fromFilename()
@@ -105,33 +121,155 @@ class Lynx:
         return
         
         
-    def getSelectionData(self,  normaxes = True):
+    def map_pixelData(self):
+        """ Returns the pixel data as read-only memory map of the file,
+            None if they are compressed or not a single grey scale frame
+        """
+        ds = self.dcmDat
+        if ds.file_meta.get('TransferSyntaxUID') not in (ExplicitVRLittleEndian, ImplicitVRLittleEndian) \
+                or ds.get('SamplesPerPixel', 1) != 1 or int(ds.get('NumberOfFrames', 1)) != 1 \
+                or ds.BitsAllocated not in (8, 16, 32):
+            return None
+        
+        # element header: tag, (explicit VR: VR and 2 reserved bytes), length
+        explicit = ds.file_meta.TransferSyntaxUID == ExplicitVRLittleEndian
+        with open(self.filename, 'rb') as f:
+            f.seek(self.pixelOffset)
+            header = f.read(12 if explicit else 8)
+        if len(header) < 8 or struct.unpack('<HH', header[:4]) != (0x7fe0, 0x0010):
+            return None
+        length = struct.unpack('<L', header[-4:])[0]
+        
+        dtype = np.dtype('<{0:s}{1:d}'.format('i' if ds.PixelRepresentation else 'u', ds.BitsAllocated // 8))
+        if length < ds.Rows * ds.Columns * dtype.itemsize:
+            return None      # undefined length (encapsulated) or truncated
+        
+        return np.memmap(self.filename, dtype=dtype, mode='r', offset=self.pixelOffset + len(header),
+                         shape=(ds.Rows, ds.Columns))
+    
+    @property
+    def pixels(self):
+        """ Pixel data as stored in the file (for display), decoded once
+            and memory-mapped where possible
+        """
+        if self._pixels is None:
+            self._pixels = self.map_pixelData()
+            if self._pixels is None:
+                self._pixels = dcmread(self.filename).pixel_array
+                self._pixels.flags.writeable = False
+        return self._pixels
+    
+    @property
+    def flipped(self):
+        """ View of the pixel data with the x axis reversed, no copy """
+        return self.pixels[:, ::-1]      # negative stride, the file stays the buffer
+    
+    @property
+    def data(self):
+        """ Flipped pixel data as self.dtype, converted on first use """
+        if self._data is None:
+            self._data = np.array(self.flipped, dtype=self.dtype)      # plain array, only pixels maps the file
+        return self._data
+    
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._cache = {}
+        
+    def get_roiIndices(self):
+        """ Returns the index limits [low, high] in x and y of the area of 
+            interest, they are kept until the range changes
+        """
+        if self._roiIndices is None:
+            # first value above the lower and last value below the upper limit,
+            # the scales are ascending
+            xInd = [np.searchsorted(self.xsc, self.xrange[0], side = "right"), 
+                    np.searchsorted(self.xsc, self.xrange[1], side = "left") - 1]
+            yInd = [np.searchsorted(self.ysc, self.yrange[0], side = "right"), 
+                    np.searchsorted(self.ysc, self.yrange[1], side = "left") - 1]
+            self._roiIndices = (xInd, yInd)
+        return self._roiIndices
+        
+    def getSelectionData(self,  normaxes = True,  writable = False):
         """ Returns the rectangular area of interest,
             and scaling vectors in x and y direction:
                 data, xsc, ysc
             if normaxes is True, the scaling vectors will start with 0
+            The data are a read-only view of the image, use writable = True 
+            to get a copy which may be changed
         """
         
         if not self.dataOK:
             print ("ERR: No data in object. Please use read_lynxDicom()")
             return 
         
-        xInd = [np.min(np.where(self.xsc > self.xrange[0])), np.max(np.where(self.xsc < self.xrange[1]))]
-        yInd = [np.min(np.where(self.ysc > self.yrange[0])), np.max(np.where(self.ysc < self.yrange[1]))]
+        xInd,  yInd = self.get_roiIndices()
         
-        xsc = copy.deepcopy(self.xsc[xInd[0]:xInd[1]] )
-        ysc = copy.deepcopy( self.ysc[yInd[0]:yInd[1]])
+        xsc = self.xsc[xInd[0]:xInd[1]]
+        ysc = self.ysc[yInd[0]:yInd[1]]
         
-        data = copy.deepcopy(self.data[yInd[0]:yInd[1], xInd[0]:xInd[1]])
+        data = self.data[yInd[0]:yInd[1], xInd[0]:xInd[1]]
+        if writable:
+            data = data.copy()
+        else:
+            data.flags.writeable = False
        
         if normaxes:
-            xsc -= xsc[0]
-            xsc -= xsc[-1] / 2.
-            ysc -= ysc[0]
-            ysc -= ysc[-1] / 2.
-        
+            xsc = xsc - (xsc[0] + (xsc[-1] - xsc[0]) / 2.)
+            ysc = ysc - (ysc[0] + (ysc[-1] - ysc[0]) / 2.)
+        else:
+            xsc.flags.writeable = False
+            ysc.flags.writeable = False
         
         return data,  xsc,  ysc
+    
+    def cached(self,  name,  compute,  *args):
+        """ Returns compute(*args) for the current area of interest, it is
+            calculated once and kept until the range or the data change.
+            Arrays are returned read-only, they are shared by all analyses.
+        """
+        key = (name, tuple(self.xrange), tuple(self.yrange)) + args
+        if key not in self._cache:
+            value = compute(*args)
+            for a in (value if isinstance(value, tuple) else (value, )):
+                if isinstance(a, np.ndarray):
+                    a.flags.writeable = False
+            self._cache[key] = value
+        return self._cache[key]
+    
+    def get_maximum(self):
+        """ Maximum of the area of interest """
+        return self.cached("maximum",  lambda: np.max(self.getSelectionData()[0]))
+    
+    def get_projections(self):
+        """ Sum of the area of interest along y and x: doseOfX, doseOfY """
+        def compute():
+            data = self.getSelectionData()[0]
+            return np.sum(data, axis = 0),  np.sum(data, axis = 1)
+        return self.cached("projections",  compute)
+    
+    def get_normalizedData(self,  norm = "max"):
+        """ Area of interest normalized to its maximum (norm = "max") or 
+            the relative deviation from its mean (norm = "mean")
+        """
+        def compute(norm):
+            data = self.getSelectionData()[0]
+            if norm == "mean":
+                return (data - np.nanmean(data)) / np.nanmean(data)
+            return data / self.get_maximum()
+        return self.cached("normalized",  compute,  norm)
+    
+    def get_plateau2D(self,  desiredFieldWidth = 100):
+        """ Plateau indices in x and y of the projections of the area of 
+            interest: pxInd, pyInd
+        """
+        def compute(desiredFieldWidth):
+            _,  xsc,  ysc = self.getSelectionData(normaxes = True)
+            doseOfX,  doseOfY = self.get_projections()
+            pxInd,  W50,  W90 = self.get_plateauIndices(xsc, doseOfX,  desiredFieldWidth = desiredFieldWidth/(xsc[1] - xsc[0]))
+            pyInd,  W50,  W90 = self.get_plateauIndices(ysc, doseOfY,  desiredFieldWidth = desiredFieldWidth/(ysc[1] - ysc[0]))
+            return pxInd,  pyInd
+        return self.cached("plateau2D",  compute,  desiredFieldWidth)
         
     def getFieldSize(self,  threshold = 0.90,  plot = True):
          """ Returns the area of the field with a value > threshold
@@ -140,16 +278,16 @@ class Lynx:
             """
          data, xsc, ysc = self.getSelectionData()
          
-         data /= np.max(data)
+         field = data > threshold * self.get_maximum()
          
          pixelSize = (xsc[1]-xsc[0]) * (ysc[1]-ysc[0])
          
-         fieldSize = np.sum(data >  threshold) * pixelSize
+         fieldSize = np.sum(field) * pixelSize
          
          if plot:
             fig = plt.figure(figsize=(8, 6), dpi=80)
             ax = plt.subplot(111)
-            im = ax.imshow(data >  threshold, extent = [xsc[0], xsc[-1], ysc[0], ysc[-1]],  cmap=plt.cm.gnuplot2,  origin = "lower")
+            im = ax.imshow(field, extent = [xsc[0], xsc[-1], ysc[0], ysc[-1]],  cmap=plt.cm.gnuplot2,  origin = "lower")
         
             plt.colorbar(im,  label = "Intensity")
         
@@ -168,17 +306,16 @@ class Lynx:
             deltaMean: ifTrue: normalize data to mean (else: norm to maximum)
         """
 
-        data, xsc, ysc = self.getSelectionData(normaxes = normaxes)
+        _, xsc, ysc = self.getSelectionData(normaxes = normaxes)
         
         if deltaMean:
-            data = (data - np.nanmean(data)) / np.nanmean(data)
+            data = self.get_normalizedData("mean")
         
             cmap = plt.cm.seismic
         else:
-            data /= np.max(data)
+            data = self.get_normalizedData("max")
             cmap = plt.cm.gnuplot2
-        data [data < clim[0]] = clim[0]
-        data [data > clim[1]] = clim[1]
+        data = np.clip(data, clim[0], clim[1])
         dataRange = clim[1]-clim[0]
         imgMax = np.max(data)
 
@@ -246,8 +383,7 @@ class Lynx:
         print ("Trying to autodetect the rectangular field")
         data,  xsc,  ysc = self.getSelectionData(normaxes = True)
         
-        doseOfX = np.sum(data, axis = 0)
-        doseOfY = np.sum(data, axis = 1)
+        doseOfX,  doseOfY = self.get_projections()
         
         x = np.zeros(2)
         y = np.zeros(2)
@@ -275,37 +411,26 @@ class Lynx:
         """
         #  -- get relevant data --
         data,  xsc,  ysc = self.getSelectionData(normaxes = True)
-        data /= np.max(data)
 
         # -- determine plateau's indices --
-        doseOfX = np.sum(data, axis = 0)
-        doseOfY = np.sum(data, axis = 1)
-       
-        xSpacing = xsc[1] -xsc [0]
-        ySpacing = ysc[1] -ysc [0]
-        
-        pxInd,  W50,  W90 = self.get_plateauIndices(xsc, doseOfX,  desiredFieldWidth = desiredFieldWidth/xSpacing)
-        pyInd,  W50,  W90 = self.get_plateauIndices(ysc, doseOfY,  desiredFieldWidth = desiredFieldWidth/ySpacing)
+        pxInd,  pyInd = self.get_plateau2D(desiredFieldWidth)
         
         #  -- prepare dose for further calculations -- 
-        doseSelect = data[   pyInd[0]:pyInd[1], pxInd[0]:pxInd[1]]
-        doseSelect /= np.mean(doseSelect)
+        doseSelect = self.get_normalizedData("max")[   pyInd[0]:pyInd[1], pxInd[0]:pxInd[1]]
+        doseSelect = doseSelect / np.mean(doseSelect)
         doseSelect *= 100.
-        xx, yy = np.meshgrid( xsc[pxInd[0]:pxInd[1]],  ysc[pyInd[0]:pyInd[1]])
+        xs = xsc[pxInd[0]:pxInd[1]]
+        ys = ysc[pyInd[0]:pyInd[1]]
         
         
         # -- fit a plane to the dose -- 
-        p0 = [0., 0.0, 1., 1.]
-        fitfunc = lambda p,   xx,  yy,  dose: \
-            np.sum((p[0]*xx + p[1]*yy + p[2]*dose - p[3])**2)
+        p = self.fit_plane(xs, ys, doseSelect)
         
         doseFunc = lambda p, xx, yy:\
             (p[3]- p[0]*xx - p[1]*yy) / p[2]
-    
-        res = optimize.minimize(fitfunc,  p0 ,args=(xx, yy,  doseSelect),method='SLSQP' )
        
-        normalVector = res.x[0:3] / np.sum(np.abs(res.x[0:3])  )
-        distanceToOrigin = res.x[3] / np.sum(np.abs(res.x[0:3])  )
+        normalVector = p[0:3] / np.sum(np.abs(p[0:3])  )
+        distanceToOrigin = p[3] / np.sum(np.abs(p[0:3])  )
         theta = np.degrees(np.arccos ( normalVector[2] / np.sqrt((np.sum([normalVector[0]**2, normalVector[1]**2, normalVector[2]**2])))))
         phi = np.degrees(np.arctan2(normalVector[1], normalVector[0]))
         print ("Normal vector = ({0:.4f},{1:.4f},{2:.4f})".format(*normalVector))
@@ -319,7 +444,7 @@ class Lynx:
 
         # -- plot the fitting procedure and the corrected dose map
        
-        doseFit = doseFunc (res.x, xx, yy)
+        doseFit = doseFunc (p, xs[np.newaxis, :], ys[:, np.newaxis])
         doseCorr = doseSelect - doseFit 
         
         # -- apply a quality criterion
@@ -334,6 +459,7 @@ class Lynx:
 
         # -- make a nice little pictue --
         if plot:
+            xx, yy = np.meshgrid(xs, ys)
             fig = plt.figure(figsize=(15, 6), dpi=80)
             ax = plt.subplot(131, projection='3d')
             im = ax.plot_surface(xx, yy,      doseSelect, alpha = 0.5)
@@ -362,17 +488,32 @@ class Lynx:
         return [self.protonEnergy,  self.measDepth, passRate,  theta,  phi]
    
   
+    def fit_plane(self, x, y, dose):
+        """ Least squares fit of the plane dose = a + b*x + c*y to a dose 
+            map on the grid x (columns), y (rows)
+            Returns p with p[0]*x + p[1]*y + p[2]*dose = p[3], p[2] = 1
+        """
+        # on a full grid the normal equations decouple for centred coordinates
+        xc = x - np.mean(x)
+        yc = y - np.mean(y)
+        
+        b = np.dot(xc, np.sum(dose, axis = 0, dtype = np.float64)) / (len(y) * np.dot(xc, xc))
+        c = np.dot(yc, np.sum(dose, axis = 1, dtype = np.float64)) / (len(x) * np.dot(yc, yc))
+        a = np.mean(dose, dtype = np.float64) - b*np.mean(x) - c*np.mean(y)
+        
+        return np.array([-b, -c, 1., a])
+    
     def plot_centralProfile(self):
         """ Plot profiles through the center of the area of interest
         """
         
-        data, xsc, ysc = self.getSelectionData()
+        _, xsc, ysc = self.getSelectionData()
 
         xMid = int(len(xsc) /2)
         yMid = int(len(ysc) /2)
      
         
-        data /= np.max(data)
+        data = self.get_normalizedData("max")
        
       
         fig = plt.figure(figsize=(10, 6), dpi=80)
@@ -400,7 +541,7 @@ class Lynx:
                 actual W50 of field
                 actual W90 of field
             """
-        dose /= np.max(dose)
+        dose = dose / np.max(dose)
         W50Li = np.min(np.where(dose > 0.5))
         W50Ri = np.max(np.where(dose > 0.5))
         W50 = xx [W50Ri] - xx [W50Li]
@@ -467,13 +608,16 @@ class Lynx:
             
             returns  out[0], out[1]
                      structures containing the calculated parameters
+            The rows of x and y (energy, depth, field width, W50, W90, flatness,
+            corrected flatness, plateau tilt, plateau width) are kept in
+            self.characteristics
         """
         
         
         data, xsc, ysc = self.getSelectionData()
         xMid = int(len(xsc) /2)
         yMid = int(len(ysc) /2)
-        data /= np.max(data)
+        # the profiles are normalized to their own maximum below
         
         
         # if plot:
@@ -491,6 +635,7 @@ class Lynx:
 
             xx = np.arange((np.min(o["abscissa"])), (np.max(o["abscissa"])))
             yy = doseItp(xx)
+            yy /= np.max(yy)
             xxSpacing = xx[1] -xx [0]
             
             plateauInd,  W50,  W90 = self.get_plateauIndices(xx, yy,  desiredFieldWidth = desiredFieldWidth)
@@ -567,6 +712,7 @@ class Lynx:
                 ax.tick_params(axis='y', colors='white')
                 #plt.legend(loc = 0)
             i += 1
+        self.characteristics = out
         if showPlot and plot:
             plt.show()
         
@@ -763,6 +909,8 @@ if __name__ == "__main__":
     parser.add_argument("-d", "--directory", type = str, nargs = 1,
                         help = "Base directory for the file selection")
     parser.add_argument("--roiLimit",  help = "Threshold used for automatic ROI detection",  type = float)
+    parser.add_argument("--dtype",  help = "Float type of the analysis (default: float32)",
+                        choices = ["float32", "float64"],  default = "float32")
 
 
     args = parser.parse_args()
@@ -785,7 +933,7 @@ if __name__ == "__main__":
     else:
         filename = os.path.expanduser (filename)
 
-    a = Lynx(filename)
+    a = Lynx(filename,  dtype = args.dtype)
     if args.x:
         
         a.set_xrange(args.x[0], args.x[1])
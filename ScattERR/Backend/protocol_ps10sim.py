@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+pyserial URL handler for ps10sim://, the simulated PS10 bus of
+Backend/PS10Sim.py. Found by serial.serial_for_url() through the entry
+'Backend' in serial.protocol_handler_packages (see Backend/PS10.py).
+"""
+
+from Backend.PS10Sim import Serial
@@ -18,7 +18,6 @@ pyqt_version = 5
 
 from interface import Ui_MainWindow
 from PyQt5.QtWidgets import QFileDialog as Qfile
-from PyQt5.QtWidgets import QMessageBox as QMessage
 
 
 
@@ -30,11 +29,23 @@ import time
 import threading
 import serial
 import configparser
-import glob
 import ctypes
 import re
+from concurrent.futures import ThreadPoolExecutor, wait
+from serial.tools import list_ports
 
 from Backend.lynxReaderMalte import Lynx
+from Backend.PS10 import (ReplyReader, PortOwner, LinkCache,
+                          CONFIG_PARAMETERS, MOTION_COMMANDS, BAUD_RATES,
+                          BAUD_COMMAND,
+                          format_command, format_query,
+                          usb_id, is_owis_port, move_duration, sync_velocities,
+                          config_hash, same_value)
+from Backend.Limits import check_targets
+from Backend.Scan import ScatterScan
+from Backend.AsyncMotor import AsyncMotorControl, QtAsyncBridge
+from Backend.Workers import (StatusPoller, Movement, ReferenceRun, MotionQueue,
+                             ConnectionManager)
 
 import PyQt5.QtWidgets as QtWidgets
 
@@ -64,6 +75,7 @@ class MotorControl(object):
 
         # Variables
         self.pos = []  # Unit: mm
+        self.position_cache = None  # (positions, timestamp) while standing still
         self.Step2MM = np.array([1E4, 1E4, 0.5E5])
 
         # IDs of PS10 elements in bus
@@ -72,13 +84,45 @@ class MotorControl(object):
         self.slaves = []
 
         self.ctrl = serial.Serial()
+        self.reader = ReplyReader(self.ctrl)
+        self.reply_timeout = 0.05  # deadline per command in s
+        self.ack_writes = False  # set commands are answered with one line
+        self.prefixed_replies = False  # replies start with the slave ID
+        self.batch_window = 8  # max. commands in flight during a batch
+
+        # all traffic goes through the I/O thread of the port owner
+        self.io = PortOwner(self)
+
+        # functions called with an event dict per command (Backend/Trace.py)
+        self.hooks = []
+
+        # link facts remembered between starts (port, slave IDs, ...)
+        self.cache = LinkCache(os.path.join(os.getcwd(), 'link.ini'))
+        self.portinfo = {}
+        self.port = None  # port or URL in use
+
+        # held for sequences of commands that must not be interleaved with
+        # those of other threads (single commands are safe anyway, see io)
+        self.lock = threading.RLock()
+        self.poller = StatusPoller(self)
+        self.queue = MotionQueue(self)  # moves requested by the GUI
+        self.connection = ConnectionManager(self)  # heartbeat and reconnect
+        self.movement = None  # last started move, see get_tablestatus
+        self.motor_config = None  # ((filename, mtime), parameters)
+
+        # coordinated moves: scale PVEL so that all axes arrive together
+        self.synchronize = False
+        self.velocities = None  # PVEL currently set per axis (None: unknown)
 
         # Set default logging of serial communication to false
         self.verbose = False
         
         self.GUI = GUI
         self.mode = 'absolute'
+        self.positioning = {}  # last ABSOL/RELAT sent to each slave
         self.limits =[210, 210, 12]
+        # boxes ((lower corner), (upper corner)) in mm no target may lie in
+        self.keepout = []
 
         # First: Find available COM ports and add to ComboBox
         self.ScanCOMPorts()
@@ -89,11 +133,16 @@ class MotorControl(object):
         self.portlist = self.get_serial_ports()         
 
 
-    def moveTable(self, vector=[0, 0, 0]):
+    def moveTable(self, vector=[0, 0, 0], synchronize=None):
         """
-        Basic executer function to move table by/to selected value
+        Basic executer function to move table by/to selected value.
+        Targets are loaded into all axes first, then all axes are started
+        together.
+        -- synchronize: scale the velocities so that all axes arrive at the
+           same time (default: self.synchronize)
         """
         vector=np.asarray(vector)
+        synchronize = self.synchronize if synchronize is None else synchronize
 
         try:
             if self.GUI is not None:
@@ -102,24 +151,44 @@ class MotorControl(object):
             else:
                 val = vector
 
-            # get current position
-            curpos = self.get_Position()
+            with self.lock:
+                # get current position
+                curpos = self.get_Position(use_cache=True)
 
 
-            if self.mode == 'absolute':
-                dest = val
-            elif self.mode == 'relative':
-                dest = curpos + val
+                if self.mode == 'absolute':
+                    dest = val
+                elif self.mode == 'relative':
+                    dest = curpos + val
 
-                
-            # convert to motor steps
-            dest = np.multiply(self.Step2MM, dest)  # convert to motor steps        
+                    
+                # reject before anything is sent to the axes
+                if not self.check_targets(dest)[0]:
+                    logging.error('Target {} mm is outside the limits or in a '
+                                  'keep-out zone. Table not moved.'.format(dest))
+                    return
+
+                # convert to motor steps
+                dest = np.multiply(self.Step2MM, dest)  # convert to motor steps        
 
 
-            # write to Axis
-            for i,slaves in enumerate(self.slaves):
-                self.serial_write(slaves, 1, 'PSET', dest[i])  # Watch out here: Depends on cable connections!!!!
-                self.serial_write(slaves, 1, 'PGO')
+                distance = dest - np.multiply(self.Step2MM, curpos)
+                velocities = self.move_velocities(distance, synchronize)
+
+                # preload velocities and targets, then start all axes
+                # Watch out here: Depends on cable connections!!!!
+                commands = []
+                for i, slave in enumerate(self.slaves):
+                    if self.velocities is None or \
+                            not same_value(self.velocities[i], velocities[i]):
+                        commands.append((slave, 1, 'PVEL', velocities[i]))
+                    commands.append((slave, 1, 'PSET', dest[i]))
+                self.serial_batch(commands)
+                self.velocities = velocities
+
+                self.serial_batch([(slave, 1, 'PGO') for slave in self.slaves])
+
+                self.movement = self.plan_movement(distance, velocities)
                 
 
         except Exception:
@@ -127,16 +196,117 @@ class MotorControl(object):
         
 
 
-    def get_Position(self):
+    def check_targets(self, targets):
+        """returns a boolean array: True for each target (mm, one row per
+            target) inside the limits and outside the keep-out zones"""
+        return check_targets(targets, self.limits, self.keepout)
+
+
+    def check_commands(self, commands):
+        """raises ValueError if a PSET of the (slaveID, nAxis, command,
+            value) commands leads outside the limits or into a keep-out
+            zone. Every command passes here before it is sent, so no move
+            target escapes the check, whoever sends it."""
+
+        positioning = dict(self.positioning)
+        targets = {}  # axis: (steps, relative)
+        for cmd in commands:
+            slaveID, _, command, value = (tuple(cmd) + ('',))[:4]
+            if command in ('ABSOL', 'RELAT'):
+                positioning[slaveID] = command
+            elif command == 'PSET':
+                if slaveID not in self.slaves[:len(self.Step2MM)]:
+                    raise ValueError('PSET for unknown axis {}'.format(slaveID))
+                targets[self.slaves.index(slaveID)] = (
+                    float(value), positioning.get(slaveID) == 'RELAT')
+
+        if targets:
+            # axes without a new target stay where they are
+            positions = np.zeros(len(self.Step2MM))
+            if len(targets) < len(positions) or \
+                    any(relative for _, relative in targets.values()):
+                positions = np.array(self.get_Position(use_cache=True), dtype=float)
+
+            dest = positions.copy()
+            for i, (steps, relative) in targets.items():
+                dest[i] = steps / self.Step2MM[i] + (positions[i] if relative else 0.)
+            if not self.check_targets(dest)[0]:
+                raise ValueError('Target {} mm is outside the limits or in a '
+                                 'keep-out zone.'.format(dest))
+
+        self.positioning = positioning
+
+
+    def stop_axes(self):
+        "stops all axes at once"
+        self.serial_batch([(slave, 1, 'STOP') for slave in self.slaves])
+
+
+    def motion_profile(self, filename = os.path.join(os.getcwd(), 'owis.ini')):
+        "returns positioning velocity and acceleration from the .ini file"
+
+        try:
+            params = self.read_motor_config(filename)
+            return float(params['PVEL']), float(params['ACC'])
+        except (configparser.Error, ValueError):
+            return 25000., 500000.
+
+
+    def move_velocities(self, distance, synchronize=False):
+        """returns the positioning velocity (steps/s) of each axis
+            -- distance: travel of each axis in motor steps
+            -- synchronize: slow down the shorter moves to end with the
+               longest one"""
+
+        vel, acc = self.motion_profile()
+        if not synchronize:
+            return [int(vel)] * len(distance)
+
+        duration = np.max(move_duration(distance, vel, acc))
+        return [max(1, int(v)) for v in sync_velocities(distance, duration, vel, acc)]
+
+
+    def plan_movement(self, distance, velocities=None):
+        """returns a Movement for a started move with predicted arrival
+            -- distance: travel of each axis in motor steps
+            -- velocities: PVEL of each axis (default: from the .ini file)"""
+
+        vel, acc = self.motion_profile()
+        if velocities is not None:
+            vel = np.asarray(velocities, dtype=float)
+        duration = move_duration(distance, vel, acc)
+
+        return Movement(range(len(distance)), float(np.max(duration)))
+
+
+    def get_Position(self, use_cache=False):
         " get current position of selected axis via USB"
 
+        return self.get_positions(use_cache)[0]
+
+
+    def get_positions(self, use_cache=False):
+        """ get current positions of all axes with one batch of queries
+            -- use_cache: reuse the last snapshot of the status poller if no
+               motion command was sent since it was taken
+            returns positions (mm) and the time they were read
+        """
+
+        cache = self.position_cache
+        if use_cache and cache is not None:
+            return cache
+
         # Watch out here: y@ Master and x@SLave!
         # may be different in other beamtimes!!!
-        x = float(self.serial_query(self.slaves[0], 1, 'CNT'))/self.Step2MM[0]
-        y = float(self.serial_query(self.slaves[1],  1, 'CNT'))/self.Step2MM[1]
-        z = float(self.serial_query(self.slaves[2],  1, 'CNT'))/self.Step2MM[2]
+        replies = self.serial_batch([(slave, 1, '?CNT') for slave
+                                     in self.slaves[:len(self.Step2MM)]])
 
-        return np.array((x, y, z))
+        return self._to_mm(replies), time.time()
+
+
+    def _to_mm(self, counts):
+        "converts replies of ?CNT for all axes to positions in mm"
+        return np.array([float(asw) for asw in counts])/self.Step2MM
 
 
     def setPositioningMode(self):
@@ -152,95 +322,259 @@ class MotorControl(object):
 
 
     # Initialization
-    def InitMotor(self):
+    def InitMotor(self, port=None, calibrate=True, negotiate=False):
         """
         function that executes everything that is necessary to initialize
         the motor
+        -- port: serial port or pyserial URL (e.g. ps10sim:// for the
+           simulated bus), default: first port found
+        -- calibrate: start the reference run afterwards
+        -- negotiate: switch to the fastest serial rate on the first start
+           with this port (the rate is remembered in link.ini). Off by
+           default: the BAUDRATE command is not verified on the axes yet
         """
 
-        port = 'COM6'
+        # port of the last successful start comes first in the list
+        if port is None:
+            if not self.portlist:
+                logging.error('No serial port found. Axes may be disconnected or '
+                              'used by another software (e.g. OWISOFT)')
+                return -1
+            port = self.portlist[0]
+        self.port = port
         self.InitializeCOM(port)
 
 
-        # Find Slaves
-        self.find_slaves(10)
+        # Find Slaves (the controllers may run at another rate than expected)
+        known = self.cache.get(port, 'baudrate') is not None
+        found = self.find_slaves(10) != -1
+        # bus scans at all other rates only if asked to change the rate
+        if not found and self.detect_baudrate(10, scan=negotiate) is not None:
+            found, known = True, False  # e.g. back at their default rate
+
+        if found:
+            self.remember_port(port)
+            if negotiate and not known:
+                self.negotiate_baudrate()
+        else:
+            logging.warning('No axes answer at {:s} ({:d} baud). Power them on, or '
+                            'scan the other rates with detect_baudrate().'
+                            .format(port, self.ctrl.baudrate))
 
-        # Next: set all motorvalues
+        # Next: set all motorvalues that differ (skipped on warm starts)
+        self.configure_slaves(self.slaves)
+
+        commands = []
         for slave in self.slaves:
-            self.config_motor(slave)
-            self.serial_write(slave, 1, 'INIT')
-            print(self.serial_query(slave,  1, 'ASTAT'))
+            commands.append((slave, 1, 'INIT'))
+            commands.append((slave, 1, '?ASTAT'))
+        replies = self.serial_batch(commands)
+
+        for cmd, asw in zip(commands, replies):
+            if cmd[2] == '?ASTAT':
+                print(asw)
             
         self.setPositioningMode()
+        if not calibrate:
+            return
+
         self.Calibrate_Motor()
-        
-        logging.info('Scatterer are calibrated and sit in parking position.')
 
 
 
     def Calibrate_Motor(self):
-        """execute reference run of object table"""
-
-        # Ask User if calibration is desired
-        Hint = QMessage()
-        Hint.setIcon(QMessage.Information)
-        Hint.setStandardButtons(QMessage.Ok)
-        Hint.setText("Calibration starts now!")
-        proceed = Hint.exec_()
-
-        # Execute Calib
-        if proceed == QMessage.Ok:
-            for slave in self.slaves:
-                self.serial_write(slave, 1, 'REF', 4)
-            
-        #logging.info('Table calibration running.')
+        """ starts the reference runs of all axes at once and returns; the
+            status poller follows them (see on_calib). Returns the
+            ReferenceRun, whose signals report progress and the result. """
+
+        with self.lock:
+            self.serial_batch([(slave, 1, 'REF', 4) for slave in self.slaves])
+
+        calibration = ReferenceRun(range(len(self.slaves)),
+                                   self.reference_duration())
+        calibration.progress.connect(self.on_calib_progress)
+        calibration.arrived.connect(lambda positions: self.on_calib(True))
+        calibration.timeout.connect(lambda positions: self.on_calib(False))
+        calibration.error.connect(lambda states: self.on_calib(False))
+        self.poller.track(calibration)
+
+        logging.info('Table calibration running.')
+        return calibration
+
+
+    def reference_duration(self):
+        "returns the predicted duration (s) of the reference runs"
+
+        try:
+            params = self.read_motor_config()
+            vel, acc = abs(float(params['RVELF'])), float(params['ACC'])
+        except (configparser.Error, ValueError):
+            vel, acc = 25000., 500000.
+
+        # worst case: an axis has to travel its whole range
+        travel = np.multiply(self.Step2MM, self.limits)
+        return float(np.max(move_duration(travel, vel, acc)))
+
+
+    def on_calib_progress(self, done, total):
+        "gets called whenever another axis finished its reference run"
+        logging.info('Reference run: {:d} of {:d} axes done.'.format(done, total))
+
 
     def on_calib(self, flag):
         "gets called when reference motion is finished"
         if flag is True:
-            GUI.BoxTableLimits.setStyleSheet("background-color: green;")
-            GUI.LabelREF.setText('Calibrated')
+            self.cache.set(self.port, 'calibrated_at',
+                           time.strftime('%Y-%m-%d %H:%M:%S'))
+            self.cache.set(self.port, 'calibrated_slaves', self.slaves)
+            logging.info('Scatterer are calibrated and sit in parking position.')
+        else:
+            logging.error('Reference run failed. Check the axes and restart.')
+
+
+    def calibrated_at(self):
+        "returns the time of the last successful reference run (or None)"
+        return self.cache.get(self.port, 'calibrated_at')
 
     # basic communication stuff
-    def serial_write(self, slaveID, nAxis, command, value=''):
+    def serial_write(self, slaveID, nAxis, command, value='', timeout=None):
         """ will format and send the given command through the COM port.
             -- command: serial command to be sent.
+            -- timeout: deadline for the reply in s (default: reply_timeout)
+            raises ValueError for a move target outside the limits
         """
 
-        # write request to COM
-        if value == '':
-            command = ("{:02d}{:s}{:d}\r\n".format(slaveID, command, nAxis))
-        else:
-            command = ("{:02d}{:s}{:d}={:s}\r\n"
-                       .format(slaveID, command, nAxis, str(value)))
-
-        command = command.encode(encoding="ASCII")
-
-        self.ctrl.write(command)
+        self.check_commands([(slaveID, nAxis, command, value)])
 
-        # Read answer from COM and print full command  + reply
-        asw = (self.ctrl.read(1024)).decode()
+        # write request to COM, read answer (as soon as it is complete)
+        return self._exchange(command, slaveID,
+                              format_command(slaveID, nAxis, command, value),
+                              timeout, self.ack_writes)
 
-        return asw
 
-
-    def serial_query(self, slaveID, nAxis, request):
+    def serial_query(self, slaveID, nAxis, request, timeout=None):
         """ will format and send the given query through the COM port.
             -- command: serial command to be sent.
+            -- timeout: deadline for the reply in s (default: reply_timeout)
         """
 
         if slaveID is None or nAxis is None:
             return 0
 
-        # write request to COM
-        request =  ("{:02d}?{:s}{:d}\r\n".format(slaveID, request, nAxis))
-        request = request.encode(encoding="ASCII")
+        # write request to COM, read answer and return
         #if self.verbose: logging.debug(request)
-        self.ctrl.write(request)
+        return self._exchange('?' + request, slaveID,
+                              format_query(slaveID, nAxis, request), timeout)
+
+
+    def _exchange(self, name, slaveID, data, timeout, expects_reply=True):
+        "sends one encoded command and returns its reply line ('' if none)"
+
+        if name in MOTION_COMMANDS:
+            self.position_cache = None
+
+        transfer = self.io.exchange([(slaveID, data, expects_reply)], 1,
+                                    self.reply_timeout if timeout is None
+                                    else timeout)
+        if self.hooks:
+            self._trace_transfer([name], transfer)
+        return transfer.replies[0]
+
+
+    def _trace(self, name, slaveID, sent, asw, requested, started, finished,
+               timed_out):
+        "passes one command to the instrumentation hooks"
+
+        event = {"command": name, "slave": slaveID, "sent": sent,
+                 "received": len(asw) + 2 if asw else 0,
+                 "start": started, "queue_wait": started - requested,
+                 "wire": finished - started, "timeout": timed_out,
+                 "thread": threading.get_ident()}
+        for hook in self.hooks:
+            hook(event)
+
+
+    def _trace_transfer(self, names, transfer):
+        "passes all commands of a finished transfer to the hooks"
+
+        for i, (slaveID, _, _) in enumerate(transfer.commands):
+            nbytes, started = transfer.sent[i]
+            finished, timed_out = transfer.received[i] or (started, False)
+            self._trace(names[i], slaveID, nbytes, transfer.replies[i],
+                        transfer.requested, started, finished, timed_out)
+
+
+    def serial_batch(self, commands, window=None, timeout=None):
+        """ sends many commands back-to-back and collects their replies.
+            -- commands: list of (slaveID, nAxis, command, value) tuples,
+               value may be omitted; queries start with '?', e.g. '?CNT'
+            -- window: max. number of commands awaiting their reply
+               (default: batch_window)
+            -- timeout: deadline per reply in s (default: reply_timeout)
+            returns the replies in the order of the commands, raises
+            ValueError for a move target outside the limits (nothing is sent)
+        """
+
+        window = self.batch_window if window is None else window
+        timeout = self.reply_timeout if timeout is None else timeout
+        self.check_commands(commands)
+
+        encoded = []
+        for cmd in commands:
+            slaveID, nAxis, command, value = (tuple(cmd) + ('',))[:4]
+
+            if command.startswith('?'):
+                encoded.append((slaveID, format_query(slaveID, nAxis, command[1:]),
+                                True))
+            else:
+                if command in MOTION_COMMANDS:
+                    self.position_cache = None
+                encoded.append((slaveID, format_command(slaveID, nAxis, command, value),
+                                self.ack_writes))
+
+        transfer = self.io.exchange(encoded, window, timeout)
+        if self.hooks:
+            self._trace_transfer([cmd[2] for cmd in commands], transfer)
+
+        return transfer.replies
+
+
+    def read_motor_config(self, filename = os.path.join(os.getcwd(), 'owis.ini')):
+        """returns the motor parameters of the given .ini file as dict.
+            The file is only parsed again when it has changed."""
+
+        key = (filename, os.path.getmtime(filename)
+               if os.path.isfile(filename) else None)
+
+        if self.motor_config is None or self.motor_config[0] != key:
+            # read config file
+            config = configparser.RawConfigParser()
+            config.read(filename)
+
+            params = {name: config.get('MOTOR', name)
+                      for name in CONFIG_PARAMETERS}
+            self.motor_config = (key, params)
+
+        return self.motor_config[1]
+
+
+    def config_commands(self, slaveID, filename = os.path.join(os.getcwd(), 'owis.ini'),
+                        current=None):
+        """returns the commands (see serial_batch) that write the motor
+            parameters of the given .ini file to the owis axis
+            -- filename: full path of .ini containing necessary information
+            -- slaveID: slaveID of motor the settings of which should be written
+            -- current: parameters read back from the axis, only values that
+               differ from these are written
+            """
+
+        params = self.read_motor_config(filename)
 
-        # Read answer from COM and return
-        asw = (self.ctrl.read(1024)).decode()
-        return asw
+        commands = [(slaveID, 1, key, params[key]) for key in CONFIG_PARAMETERS
+                    if current is None or not same_value(params[key], current.get(key))]
+        commands.append((slaveID, 1, 'ABSOL'))  # default setting: absolute positioning
+
+        return commands
 
 
     def config_motor(self, slaveID, filename = os.path.join(os.getcwd(), 'owis.ini')):
@@ -250,62 +584,81 @@ class MotorControl(object):
             -- slaveID: slaveID of motor the settings of which should be written
             """
 
-        # read config file
-        config = configparser.RawConfigParser()
-        config.read(filename)
+        #write values to axis
+        self.configure_slaves([slaveID], filename, force=True)
+
+
+    def configure_slaves(self, slaves, filename = os.path.join(os.getcwd(), 'owis.ini'),
+                         force=False):
+        """writes the parameters of the .ini file to the given slaves, but
+            only those that differ from the values on the controllers.
+            Slaves that got the same file at the last start and have not
+            been reset since (axis state not 'I') are skipped entirely.
+            -- force: read back and compare even if the snapshot matches
+            returns the list of slaves that got new values
+            """
 
+        params = self.read_motor_config(filename)
+        fingerprint = config_hash(params)
 
-        #write values to axis
-        self.serial_write(slaveID, 1, 'SMK',       config.get('MOTOR', 'SMK'))
-        self.serial_write(slaveID, 1, 'SMK',       config.get('MOTOR', 'SMK'))
-        self.serial_write(slaveID, 1, 'SPL',       config.get('MOTOR', 'SPL'))
-        self.serial_write(slaveID, 1, 'RMK',       config.get('MOTOR', 'RMK'))
-        self.serial_write(slaveID, 1, 'RPL',       config.get('MOTOR', 'RPL'))
-        self.serial_write(slaveID, 1, 'RVELF',     config.get('MOTOR', 'RVELF'))
-        self.serial_write(slaveID, 1, 'RVELS',     config.get('MOTOR', 'RVELS'))
-        self.serial_write(slaveID, 1, 'ACC',       config.get('MOTOR', 'ACC'))
-        self.serial_write(slaveID, 1, 'PVEL',      config.get('MOTOR', 'PVEL'))
-        self.serial_write(slaveID, 1, 'FVEL',      config.get('MOTOR', 'FVEL'))
-        self.serial_write(slaveID, 1, 'PHINTIM',   config.get('MOTOR', 'PHINTIM'))
-        self.serial_write(slaveID, 1, 'MCSTP',     config.get('MOTOR', 'MCSTP'))
-        self.serial_write(slaveID, 1, 'DRICUR',    config.get('MOTOR', 'DRICUR'))
-        self.serial_write(slaveID, 1, 'HOLCUR',    config.get('MOTOR', 'HOLCUR'))
-        self.serial_write(slaveID, 1, 'ATOT',      config.get('MOTOR', 'ATOT'))
-        self.serial_write(slaveID, 1, 'MOTYPE',    config.get('MOTOR', 'MOTYPE'))
-        self.serial_write(slaveID, 1, 'MAXOUT',    config.get('MOTOR', 'MAXOUT'))
-        self.serial_write(slaveID, 1, 'AMPSHNT',   config.get('MOTOR', 'AMPSHNT'))
-        self.serial_write(slaveID, 1, 'AMPPWMF',   config.get('MOTOR', 'AMPPWMF'))
-        self.serial_write(slaveID, 1, 'ABSOL')  # default setting: absolute positioning
-
-
-    def find_slaves(self, Range):
+        # warm start: configured with this file and powered ever since
+        states = self.serial_batch([(slave, 1, '?ASTAT') for slave in slaves])
+        todo = [slave for slave, state in zip(slaves, states) if force or
+                state[:1] in ('', 'I') or
+                self.cache.get(self.port, 'config_{:d}'.format(slave)) != fingerprint]
+        if not todo:
+            return []
+
+        # read back all parameters of all remaining slaves in one pass
+        keys = sorted(set(CONFIG_PARAMETERS))
+        replies = self.serial_batch([(slave, 1, '?' + key)
+                                     for slave in todo for key in keys])
+
+        commands = []
+        for i, slave in enumerate(todo):
+            current = dict(zip(keys, replies[i*len(keys):(i+1)*len(keys)]))
+            commands += self.config_commands(slave, filename, current)
+        self.serial_batch(commands)
+        self.velocities = None  # PVEL is back at the value of the file
+
+        for slave in todo:
+            self.cache.set(self.port, 'config_{:d}'.format(slave), fingerprint)
+
+        return todo
+
+
+    def find_slaves(self, Range, window=0.1, expected=None, use_cache=True):
         """sends a testmessage to all slaves in range 0 to Range and listens
-            for an answer. """
+            for an answer.
+            -- window: time in s to wait for answers
+            -- expected: number of axes in the bus, the scan stops as soon as
+               all of them answered (default: one per axis limit)
+            -- use_cache: verify the slaves found at the last start instead
+               of scanning the bus again
+            """
 
         self.MasterID = 0  # MasterID is always 00 - right?
         # check if serial port is open
         if not self.ctrl.is_open:
             return -1
 
+        if expected is None:
+            expected = len(self.limits)
+
+        # First: check if the slaves of the last start are still there
+        cached = self.cache.get_list(self.port, 'slaves')
+        if use_cache and cached and self.verify_slaves(cached, window):
+            self.slaves = cached
+
         # Otherwise, browse all slaveIDs in given range
-        for I in range(1, Range):
-            asw = self.serial_query(I, 1, 'ASTAT') # request status
-            time.sleep(1)
-
-            # check if an answer came
-            if asw == '':
-                if I == Range -1:
-                    # If maximum number of IDs have been checked, throw error
-                    #logging.error('No Master/Slave structure found')
-                    return -1
-                else:
-                    continue
+        else:
+            self.slaves = self.scan_slaves(Range, window, expected)
 
-            # If reply comes:
-            else:
-                # break loop
-                self.slaves.append(I)
-                #logging.debug('Found Slave at ID={:d}'.format(I))
+            if not self.slaves:
+                #logging.error('No Master/Slave structure found')
+                return -1
+
+            self.cache.set(self.port, 'slaves', self.slaves)
 
         try:
             self.StatusWatchDog.MID = self.MasterID
@@ -315,92 +668,340 @@ class MotorControl(object):
 
 
 
-    def get_serial_ports(self):
+    def scan_slaves(self, Range, window, expected):
+        """probes the slaveIDs 1 to Range-1 and returns those that answer.
+            Stops as soon as the expected number of slaves has answered."""
+
+        found = []
+
+        if self.prefixed_replies:
+            # answers carry the slave ID: send all probes at once and
+            # collect the answers within one window
+            with self.io.exclusive():
+                for I in range(1, Range):
+                    self.ctrl.write(format_query(I, 1, 'ASTAT'))
+
+                deadline = time.monotonic() + window
+                while len(found) < expected:
+                    asw = self.reader.readline(max(0, deadline - time.monotonic()))
+                    if self.reader.timed_out:
+                        break  # window over, a cut off line is no answer
+                    if len(asw) > 2 and asw[:2].isdigit() and \
+                            int(asw[:2]) in range(1, Range):
+                        found.append(int(asw[:2]))
+
+                # drop answers of slaves that came in after the early stop
+                time.sleep(self.reply_timeout)
+                self.reader.flush()
+
+        else:
+            # bare answers can only be assigned one probe at a time
+            for I in range(1, Range):
+                if self.serial_query(I, 1, 'ASTAT', timeout=window) != '':
+                    found.append(I)
+                    #logging.debug('Found Slave at ID={:d}'.format(I))
+                if len(found) >= expected:
+                    break
+
+        return sorted(set(found))
+
+
+    def verify_slaves(self, slaves, window):
+        "returns True if all given slaves answer a status request"
+
+        replies = self.serial_batch([(I, 1, '?ASTAT') for I in slaves],
+                                    timeout=window)
+        return all(asw != '' for asw in replies)
+
+
+    def get_serial_ports(self, probe_timeout=0.5):
 
         """ Lists serial port names
 
-            :raises EnvironmentError:
-                On unsupported or unknown platforms
+            Uses the port listing of the OS. If OWIS controllers are among
+            the listed ports, only those are returned. The port used at the
+            last successful start comes first.
+            -- probe_timeout: time in s to check in parallel that the
+               ports are not used by another program
             :returns:
                 A list of the serial ports available on the system
         """
 
-        if sys.platform.startswith('win'):
-            ports = ['COM%s' % (i + 1) for i in range(256)]
-        elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-            # this excludes your current terminal "/dev/tty"
-            ports = glob.glob('/dev/tty[A-Za-z]*')
-        elif sys.platform.startswith('darwin'):
-            ports = glob.glob('/dev/tty.*')
-        else:
-            raise EnvironmentError('Unsupported platform')
+        ports = list_ports.comports()
+        self.portinfo = {info.device: info for info in ports}
+
+        known_id = self.cache.get('PORT', 'usb_id')
+        owis = [info for info in ports if is_owis_port(info, known_id)]
+        candidates = [info.device for info in (owis or ports)]
+
+        last = self.cache.get('PORT', 'name')
+        if last in candidates:
+            candidates.remove(last)
+            candidates.insert(0, last)
+
+        if not candidates:
+            return []
+
+        # open all candidates at once, skip those that do not answer in time
+        pool = ThreadPoolExecutor(max_workers=min(16, len(candidates)))
+        futures = [pool.submit(self.probe_port, port) for port in candidates]
+        wait(futures, timeout=probe_timeout)
+        pool.shutdown(wait=False)
+
+        return [port for port, future in zip(candidates, futures)
+                if future.done() and future.result()]
+
+
+    def probe_port(self, port):
+        "returns True if the port can be opened"
+
+        try:
+            s = serial.Serial(port)
+            s.close()
+            return True
+        except (OSError, serial.SerialException):
+            return False
+
 
-        result = []
-        for port in ports:
+    def remember_port(self, port):
+        "stores the port (and its USB IDs) for the next start"
+
+        if '://' in port:
+            return  # URLs (e.g. the simulated bus) are not listed as ports
+        self.cache.set('PORT', 'name', port)
+
+        info = self.portinfo.get(port)
+        if info is not None and usb_id(info) is not None:
+            self.cache.set('PORT', 'usb_id', usb_id(info))
+
+
+    def reconnect(self):
+        """ reopens the link after it was lost and restores what the axes
+            may have lost meanwhile: configuration, INIT and positioning mode
+            returns True if all known slaves answer again
+        """
+
+        with self.lock, self.io.exclusive():
             try:
-                s = serial.Serial(port)
-                s.close()
-                result.append(port)
-            except (OSError, serial.SerialException):
+                self.ctrl.close()
+            except (serial.SerialException, OSError):
                 pass
-        return result
+            self.position_cache = None
+            self.velocities = None
+
+            if self.InitializeCOM(self.port) == -1 or \
+                    not (self.verify_slaves(self.slaves, self.reply_timeout) or
+                         self.detect_baudrate() is not None):
+                # a USB adapter may come back under another name
+                if '://' in self.port:
+                    return False
+                self.ScanCOMPorts()
+                for port in self.portlist:
+                    if port != self.port and self.InitializeCOM(port) != -1 and \
+                            self.verify_slaves(self.slaves, self.reply_timeout):
+                        self.port = port
+                        self.remember_port(port)
+                        break
+                else:
+                    return False
+
+            # axes that were powered off need configuration and INIT again
+            self.configure_slaves(self.slaves)
+            states = self.serial_batch([(slave, 1, '?ASTAT') for slave in self.slaves])
+            powered_off = [slave for slave, state in zip(self.slaves, states)
+                           if state[:1] == 'I']
+            if powered_off:
+                self.serial_batch([(slave, 1, 'INIT') for slave in powered_off])
+            self.setPositioningMode()
+
+        logging.info('Connection to the axes restored ({:s}).'.format(self.port))
+        if powered_off:
+            logging.warning('Axes {} were powered off: positions are not '
+                            'referenced, run the calibration again.'.format(powered_off))
+        return True
+
+
+    def detect_baudrate(self, Range=10, rates=BAUD_RATES, scan=True):
+        """looks for the slaves at the other serial rates
+            -- scan: scan the whole bus at each rate if the slaves of the
+               last start do not answer there (takes seconds per rate)
+            returns the rate they answer at (stored in link.ini) or None"""
+
+        start = self.ctrl.baudrate
+        rates = [rate for rate in rates if rate != start]
+        cached = self.cache.get_list(self.port, 'slaves')
+
+        # quick pass with the slaves of the last start, then scan the bus
+        for use_cache in (True, False):
+            if (use_cache and not cached) or not (use_cache or scan):
+                continue
+            for rate in rates:
+                self.set_host_baudrate(rate)
+                if use_cache and self.verify_slaves(cached, 0.1):
+                    self.slaves = cached
+                elif use_cache or self.find_slaves(Range, use_cache=False) == -1:
+                    continue
+
+                self.cache.set(self.port, 'baudrate', rate)
+                logging.info('Axes found at {:d} baud.'.format(rate))
+                return rate
+
+        self.set_host_baudrate(start)
+        return None
+
+
+    def negotiate_baudrate(self, rates=BAUD_RATES, checks=10):
+        """switches controllers and host to the fastest rate that works
+            reliably.
+            -- rates: candidates, tried from the fastest down
+            -- checks: status requests to all slaves that must all be
+               answered at the new rate
+            returns the rate in use afterwards (stored in link.ini)
+        """
+
+        current = self.ctrl.baudrate
+        with self.lock:
+            for rate in sorted(rates, reverse=True):
+                if rate <= current:
+                    break
+                if self.switch_baudrate(rate, checks):
+                    current = rate
+                    break
+
+                # controllers that did switch are sent back, host follows
+                self.serial_batch([(slave, 1, BAUD_COMMAND, current)
+                                   for slave in self.slaves])
+                self.set_host_baudrate(current)
+                if not self.link_stable(1):
+                    current = self.detect_baudrate() or current
+                    break
 
+        self.cache.set(self.port, 'baudrate', current)
+        logging.info('Serial link runs at {:d} baud.'.format(current))
+        return current
 
-    def InitializeCOM(self, port, baudrate = 9600, bytesize = serial.EIGHTBITS,
+
+    def switch_baudrate(self, rate, checks=10):
+        """tells all slaves to change their serial rate and follows with the
+            host. Returns True if all slaves answer reliably afterwards."""
+
+        self.serial_batch([(slave, 1, BAUD_COMMAND, rate) for slave in self.slaves])
+        self.set_host_baudrate(rate)
+        return self.link_stable(checks)
+
+
+    def set_host_baudrate(self, rate):
+        "changes the serial rate of the open port"
+
+        with self.io.exclusive():
+            self.ctrl.baudrate = rate
+            self.reader.flush()
+
+
+    def link_stable(self, checks):
+        "returns True if all slaves answer the given number of status requests"
+        return all(self.verify_slaves(self.slaves, self.reply_timeout)
+                   for _ in range(checks))
+
+
+    def InitializeCOM(self, port, baudrate = None, bytesize = serial.EIGHTBITS,
                       parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE,
                       rtscts=False, xonxoff=True, timeout=0.05, writeTimeout=0.05):
 
         """Function to initialize the serial communication
             - port: Set COM-Port that is connected to the OWIS components
+            - baudrate: default is the rate last used at this port (9600
+              for a new port)
             - all other necessary parameters are default parameters
         """
+        if baudrate is None:
+            baudrate = int(self.cache.get(port, 'baudrate', 9600))
+
         #logging.debug('Trying to open serial connection.')
-        self.ctrl.port          = port
-        self.ctrl.baudrate      = baudrate
-        self.ctrl.bytesize      = bytesize
-        self.ctrl.parity        = parity
-        self.ctrl.stopbits      = stopbits
-        self.ctrl.rtscts        = rtscts
-        self.ctrl.xonxoff       = xonxoff
-        self.ctrl.timeout       = timeout
-        self.ctrl.writeTimeout  = writeTimeout
+        # the I/O thread must not touch the port while it is replaced
+        with self.io.exclusive():
+            if '://' in port:
+                # pyserial URL, e.g. ps10sim:// (Backend/PS10Sim.py)
+                self.ctrl = serial.serial_for_url(port, do_not_open=True)
+                self.reader = ReplyReader(self.ctrl)
+            else:
+                self.ctrl.port      = port
+            self.ctrl.baudrate      = baudrate
+            self.ctrl.bytesize      = bytesize
+            self.ctrl.parity        = parity
+            self.ctrl.stopbits      = stopbits
+            self.ctrl.rtscts        = rtscts
+            self.ctrl.xonxoff       = xonxoff
+            self.ctrl.timeout       = timeout
+            self.ctrl.writeTimeout  = writeTimeout
 
-        try:
-            self.ctrl.open()
-        except Exception:
-            return -1
-        
+            try:
+                self.ctrl.open()
+            except Exception:
+                return -1
+
+            self.reader.clear()
         
         
         
-    def get_tablestatus(self):
         
-        GUI.enable_buttons(False)
+    def get_status(self):
+        """returns current positions and states (first status character)
+            of all axes, read without interruption by other commands"""
+
+        axes = self.slaves[:len(self.Step2MM)]
+        commands = ([(slave, 1, '?ASTAT') for slave in self.slaves] +
+                    [(slave, 1, '?CNT') for slave in axes])
+
+        with self.lock:
+            replies = self.serial_batch(commands)
+
+            states = [asw[0] for asw in replies[:len(self.slaves)]]
+            positions = self._to_mm(replies[len(self.slaves):])
+
+            # standing still: positions stay valid until the next motion
+            if all(state == 'R' for state in states):
+                self.position_cache = (positions, time.time())
+
+        return positions, states
         
-        t = threading.Timer(1, self.get_tablestatus)
-        t.start()
-            
-        MID = 1
-        SID2 = 2
-        SID3 = 3
-        self.MState = self.serial_query(MID, 1, 'ASTAT')[0]
-        self.SState2 = self.serial_query(SID2, 1, 'ASTAT')[0]
-        self.SState3 = self.serial_query(SID3, 1, 'ASTAT')[0]
-            
-            
-            
-        #if self.MState == 'T' or self.SState2 == 'T' or self.SState3 == 'T':
-        cur_pos = self.get_Position()
         
-        GUI.edit_s1_cur_x.setText('{:4.2f}'.format(cur_pos[1])) #s1h
-        GUI.edit_s2_cur_x.setText('{:4.2f}'.format(cur_pos[0]))
-        GUI.edit_s2_cur_y.setText('{:4.2f}'.format(cur_pos[2]))
-                
+    def get_tablestatus(self):
+        """disables the buttons and lets the poller watch the axes until
+            all of them stand still again (see MainWindow.update_status)"""
         
-        if self.MState == 'R' and self.SState2 == 'R' and self.SState3 == 'R':
-            #print('motor stopped')
-            t.cancel()
-            GUI.enable_buttons(True)
+        # supervise the last move, buttons come back when it is over
+        movement, self.movement = self.movement, None
+        if movement is None:
+            GUI.enable_buttons(False)
+            self.poller.poke()
+            return
+
+        self.watch_movement(movement)
+        self.poller.track(movement)
+
+
+    def watch_movement(self, movement):
+        """disables the buttons until the given move is over (for moves of
+            the motion queue, which tracks them itself)"""
+
+        GUI.enable_buttons(False)
+        movement.arrived.connect(lambda positions: GUI.enable_buttons(True))
+        movement.timeout.connect(self.on_move_timeout)
+        movement.error.connect(self.on_move_error)
+
+
+    def on_move_timeout(self, positions):
+        "gets called when a move takes much longer than predicted"
+        logging.warning('Scatterer did not arrive in time. Scatterer position: '
+                        'x_s1 = {:.2f} mm, x_s2 = {:.2f} mm, y_s2 = {:.2f} mm'
+                        .format(positions[1], positions[0], positions[2]))
+
+
+    def on_move_error(self, states):
+        "gets called when an axis reports an error state while moving"
+        logging.error('Axis error during movement (states: {:s})'.format(states))
+        GUI.enable_buttons(True)
             
 
 
@@ -421,6 +1022,9 @@ class MainWindow(QMain, Ui_MainWindow):
         #Initialize GUI and load stylesheet
         self.setupUi(self)
 
+        # motor coroutines run next to the Qt loop, the GUI never waits for the bus
+        self.bridge = QtAsyncBridge()
+
         # park and beam buttons
         # Set up Combo box for positioning mode and connect
           
@@ -439,6 +1043,10 @@ class MainWindow(QMain, Ui_MainWindow):
         
         #adjust button
         self.button_s2_adjust.clicked.connect(self.adjust_s2)
+
+        #scan button: adjusts the 2nd scatterer with new images of a folder
+        self.scan = None
+        self.button_s2_scan.clicked.connect(self.scan_s2)
         
         #in vivo/vitro buttons
         self.button_in_vivo.clicked.connect(self.vivoposition)
@@ -460,27 +1068,19 @@ class MainWindow(QMain, Ui_MainWindow):
         self.button_in_vitro.setEnabled(enable)
         self.Button_MoveTable.setEnabled(enable)
         self.button_load_dcm_image.setEnabled(enable)
+        self.button_s2_scan.setEnabled(enable or (self.scan is not None and
+                                                  self.scan.running))
         
         
     
     def parkposition_s1(self):
         
         position = GUI.CBoxPARKBEAM_s1.currentText()
-        self.SState2 = Motor.serial_query(2, 1, 'ASTAT')[0]
         if position == 'PARK':
-            if self.SState2 == 'R':
-                Motor.mode = 'absolute'
-                pos = Motor.get_Position()
-                target = [pos[0], 0, pos[2]]
-                #print target coordinates
-                self.target_coordinates(target)
-                #move table to target destination
-                Motor.moveTable(vector=target)
-                #get current coordinates
-                Motor.get_tablestatus()
-                
-                logging.info('\'Park\' option for 1st scatterer chosen. Scatterer is now moving to parking position. Scatterer position: x_s1 = {} mm,'
-                     'x_s2 = {} mm, y_s2 = {} mm'.format(target[1], target[0], target[2]))
+            #queue move to target destination if the scatterer stands still
+            self.queue_move(Motion.move_if_ready([None, 0, None]),
+                '\'Park\' option for 1st scatterer chosen. Scatterer is now moving to parking position. Scatterer position: x_s1 = {} mm,'
+                'x_s2 = {} mm, y_s2 = {} mm')
                         
        
 
@@ -489,42 +1089,21 @@ class MainWindow(QMain, Ui_MainWindow):
         """
         
         position = GUI.CBoxPARKBEAM_s1.currentText()
-        self.SState2 = Motor.serial_query(2, 1, 'ASTAT')[0]
         if position == 'BEAM':
-             if self.SState2 == 'R':
-                Motor.mode = 'absolute'
-                pos = Motor.get_Position()
-                target = [pos[0], 181, pos[2]]
-                #print target coordinates
-                self.target_coordinates(target)
-                #move table to target destination
-                Motor.moveTable(vector=target)
-                #get current coordinates
-                Motor.get_tablestatus()
-                
-                logging.info('\'Beam\' option for 1st scatterer chosen. Scatterer is now moving to beam position. Scatterer position: x_s1 = {} mm,'
-                     'x_s2 = {} mm, y_s2 = {} mm'.format(target[1], target[0], target[2]))
+            #queue move to target destination if the scatterer stands still
+            self.queue_move(Motion.move_if_ready([None, 181, None]),
+                '\'Beam\' option for 1st scatterer chosen. Scatterer is now moving to beam position. Scatterer position: x_s1 = {} mm,'
+                'x_s2 = {} mm, y_s2 = {} mm')
         
         
         
     def parkposition_s2(self):
         position = GUI.CBoxPARKBEAM_s2.currentText()
-        self.MState = Motor.serial_query(1, 1, 'ASTAT')[0]
-        self.SState3 = Motor.serial_query(3, 1, 'ASTAT')[0]
         if position == 'PARK':
-            if self.MState == 'R' and self.SState3 == 'R':
-                Motor.mode = 'absolute'
-                pos = Motor.get_Position()
-                target = [0, pos[1], 0]
-                #print target coordinates
-                self.target_coordinates(target)
-                #move table to target destination
-                Motor.moveTable(vector=target)
-                #get current coordinates
-                Motor.get_tablestatus()
-                
-                logging.info('\'Park\' option for 2nd scatterer chosen. Scatterer is now moving to parking position. Scatterer position: x_s1 = {} mm,'
-                     'x_s2 = {} mm, y_s2 = {} mm'.format(target[1], target[0], target[2]))
+            #queue move to target destination if the scatterer stands still
+            self.queue_move(Motion.move_if_ready([0, None, 0]),
+                '\'Park\' option for 2nd scatterer chosen. Scatterer is now moving to parking position. Scatterer position: x_s1 = {} mm,'
+                'x_s2 = {} mm, y_s2 = {} mm')
             
         
     def beamposition_s2(self):
@@ -532,101 +1111,144 @@ class MainWindow(QMain, Ui_MainWindow):
         vertical: 6mm
         """
         position = GUI.CBoxPARKBEAM_s2.currentText()
-        self.MState = Motor.serial_query(1, 1, 'ASTAT')[0]
-        self.SState3 = Motor.serial_query(3, 1, 'ASTAT')[0]
         if position == 'BEAM':
-            if self.MState == 'R' and self.SState3 == 'R':
-                Motor.mode = 'absolute'
-                pos = Motor.get_Position()
-                target = [181, pos[1], 6]
-                #print target coordinates
-                self.target_coordinates(target)
-                #move table to target destination
-                Motor.moveTable(vector=target)
-                #get current coordinates
-                Motor.get_tablestatus()
-                
-                logging.info('\'Beam\' option for 2nd scatterer chosen. Scatterer is now moving to beam position. Scatterer position: x_s1 = {} mm, '
-                     'x_s2 = {} mm, y_s2 = {} mm'.format(target[1], target[0], target[2]))
+            #queue move to target destination if the scatterer stands still
+            self.queue_move(Motion.move_if_ready([181, None, 6]),
+                '\'Beam\' option for 2nd scatterer chosen. Scatterer is now moving to beam position. Scatterer position: x_s1 = {} mm, '
+                'x_s2 = {} mm, y_s2 = {} mm')
         
     
     def adjust_s2(self):
-        Motor.mode = 'relative'
-        pos = Motor.get_Position()
         target = [self.corr[0], 0, self.corr[1]]
-        #print target coordinates
-        log_target = pos+target
-        self.target_coordinates(log_target)
-        #move table to target destination
-        Motor.moveTable(vector=target)     
-        #get current coordinates
-        Motor.get_tablestatus()         
-        
-        logging.info('\'Adjust\' button for 2nd scatterer pressed. Moving table by: dx = {:.2f} mm, '
-                     'dy = {:.2f} mm. Scatterer position: x_s1 = {:.2f} mm, x_s2 = {:.2f} mm, y_s2 = {:.2f} mm'.format(self.corr[0], self.corr[1], log_target[1],
-                     log_target[0], log_target[2]))
-        
-        log_text = self.LogBox.itemAt(0).widget().toPlainText()
-        f= open(self.base+"/logfile.txt","w+")
-        f.write(log_text)
-        f.close() 
+        #queue move by the correction
+        self.queue_move(Motion.move_by(target, wait=False),
+            '\'Adjust\' button for 2nd scatterer pressed. Moving table by: dx = {:.2f} mm, '
+            'dy = {:.2f} mm. '.format(self.corr[0], self.corr[1]) +
+            'Scatterer position: x_s1 = {:.2f} mm, x_s2 = {:.2f} mm, y_s2 = {:.2f} mm',
+            save_log=True)
     
 
+    def scan_s2(self):
+        "starts the scan of the 2nd scatterer (or stops the running one)"
+
+        if self.scan is not None and self.scan.running:
+            self.scan.stop()
+            return
+
+        folder = Qfile.getExistingDirectory(self, 'Folder of the new Lynx images')
+        if not folder:
+            return
+
+        self.scan = ScatterScan(Motor.queue, folder)
+        self.scan.moving.connect(lambda position: self.target_coordinates(
+            Motor.queue.planned()))
+        self.scan.measured.connect(self.on_scan_measured)
+        self.scan.finished.connect(self.on_scan_finished)
+        self.scan.start()
+        self.button_s2_scan.setText('STOP SCAN')
+
+
+    def on_scan_measured(self, position, correction):
+        self.corr = list(correction)
+        self.edit_correction_x.setText('{:4.2f}'.format(correction[0]))
+        self.edit_correction_y.setText('{:4.2f}'.format(correction[1]))
+
+
+    def on_scan_finished(self, position, converged):
+        self.button_s2_scan.setText('SCAN')
+        if converged:
+            logging.info('Scan finished: field is flat at x_s2 = {:.2f} mm, '
+                         'y_s2 = {:.2f} mm.'.format(position[0], position[1]))
+        else:
+            logging.warning('Scan stopped before the field was flat. Last target: '
+                            'x_s2 = {:.2f} mm, y_s2 = {:.2f} mm.'.format(position[0],
+                                                                      position[1]))
+
+
     def vivoposition(self):
         
-        Motor.mode = 'absolute'
         target = [0, 0, 0]
         #print target coordinates
         self.target_coordinates(target)
         #change dropdown button to beam position
 #        GUI.CBoxPARKBEAM_s1.setText('Beam')
-        #move table to target destination
-        Motor.moveTable(vector=target)
-        #get current coordinates
-        Motor.get_tablestatus()
-        
-        logging.info('\'In vivo\' button for both scatterer pressed. Scatterer are now moving to parking position. Scatterer position: x_s1 = {} mm, '
-                     'x_s2 = {} mm, y_s2 = {} mm'.format(target[1], target[0], target[2]))
+        #queue move to target destination
+        self.queue_move(Motion.move_to(target, wait=False),
+            '\'In vivo\' button for both scatterer pressed. Scatterer are now moving to parking position. Scatterer position: x_s1 = {} mm, '
+            'x_s2 = {} mm, y_s2 = {} mm')
         
         self.CBoxPARKBEAM_s1.setCurrentIndex(0)
         self.CBoxPARKBEAM_s2.setCurrentIndex(0)
     
     def vitroposition(self):
         
-        Motor.mode = 'absolute'
         target = [181, 181, 6]
         #print target coordinates
         self.target_coordinates(target)
-        #move table to target destination
-        Motor.moveTable(vector=target)
-        #get current coordinates
-        Motor.get_tablestatus()
-        
-        logging.info('\'In vitro\' button for both scatterer pressed. Scatterer are now moving to beam position. Scatterer position: x_s1 = {} mm, '
-                     'x_s2 = {} mm, y_s2 = {} mm'.format(target[1], target[0], target[2]))
+        #queue move to target destination
+        self.queue_move(Motion.move_to(target, wait=False),
+            '\'In vitro\' button for both scatterer pressed. Scatterer are now moving to beam position. Scatterer position: x_s1 = {} mm, '
+            'x_s2 = {} mm, y_s2 = {} mm')
 
         self.CBoxPARKBEAM_s1.setCurrentIndex(1)
         self.CBoxPARKBEAM_s2.setCurrentIndex(1)
 
     def manual_move(self):
-        Motor.mode = 'absolute'
         target = np.array((GUI.SpinBoxTablex_s2.value(),
                             GUI.SpinBoxTablex_s1.value(),
                             GUI.SpinBoxTabley_s2.value()))
         #print target coordinates
         self.target_coordinates(target)
-        #move table to target destination
-        Motor.moveTable(vector=target)
-        #get current coordinates
-        Motor.get_tablestatus()
-        
-        logging.info('\'Move\' button for both scatterer pressed. Scatterer are now moving to position: x_s1 = {} mm, '
-                     'x_s2 = {} mm, y_s2 = {} mm'.format(target[1], target[0], target[2]))
-        
-        log_text = self.LogBox.itemAt(0).widget().toPlainText()
-        f= open(self.base+"/logfile.txt","w+")
-        f.write(log_text)
-        f.close() 
+        #queue move to target destination
+        self.queue_move(Motion.move_to(list(target), wait=False),
+            '\'Move\' button for both scatterer pressed. Scatterer are now moving to position: x_s1 = {} mm, '
+            'x_s2 = {} mm, y_s2 = {} mm', save_log=True)
+
+
+    def queue_move(self, coro, message, save_log=False):
+        """ runs a move coroutine of Motion in the background. When the move
+            is queued, its target is shown and message is logged, formatted
+            with the planned x_s1, x_s2, y_s2 """
+
+        self.bridge.submit(coro, lambda target: self.on_move_queued(
+            target, message, save_log))
+
+
+    def on_move_queued(self, target, message, save_log):
+        if target is None:
+            return  # scatterer still moving, request ignored
+
+        #print target coordinates
+        self.target_coordinates(target)
+        logging.info(message.format(target[1], target[0], target[2]))
+
+        if save_log:
+            log_text = self.LogBox.itemAt(0).widget().toPlainText()
+            f= open(self.base+"/logfile.txt","w+")
+            f.write(log_text)
+            f.close()
+
+
+    def update_status(self, positions, states):
+        "receives the snapshots of the status poller"
+
+        self.edit_s1_cur_x.setText('{:4.2f}'.format(positions[1])) #s1h
+        self.edit_s2_cur_x.setText('{:4.2f}'.format(positions[0]))
+        self.edit_s2_cur_y.setText('{:4.2f}'.format(positions[2]))
+
+        if all(state == 'R' for state in states):
+            #print('motor stopped')
+            self.enable_buttons(True)
+
+
+    def update_queue(self, depth, eta):
+        "shows the state of the motion queue"
+
+        if depth == 0 and eta == 0:
+            self.statusBar().clearMessage()
+        else:
+            self.statusBar().showMessage('{:d} moves queued, done in {:.1f} s'
+                                         .format(depth, eta))
 
 
     def target_coordinates(self, tar):
@@ -655,7 +1277,7 @@ class MainWindow(QMain, Ui_MainWindow):
         
         
         #img = np.rot90(np.rot90(data.pixel_array))
-        self.Display_dcm_image.canvas.axes.imshow(self.Lynxdata.dcmDat.pixel_array)
+        self.Display_dcm_image.canvas.axes.imshow(self.Lynxdata.pixels)
         #self.Display_dcm_image
         
         self.Display_dcm_image.canvas.axes.set_xlabel("x [mm]")
@@ -724,6 +1346,12 @@ class MainWindow(QMain, Ui_MainWindow):
 
     def closeEvent(self, event):
         
+        if self.scan is not None:
+            self.scan.stop()
+        Motor.queue.shutdown()
+        self.bridge.stop()
+        Motor.connection.stop()
+        Motor.poller.stop()
         self.close()
         logging.getLogger().handlers = []
         
@@ -793,8 +1421,20 @@ if __name__=="__main__":
     
     dlg=MyDialog()
     
+    # optional: port or URL of the axes, e.g. ps10sim:// to run offline
+    port = sys.argv[1] if len(sys.argv) > 1 else None
+
     Motor = MotorControl()
-    Motor.InitMotor()
+    Motor.InitMotor(port)
+    Motion = AsyncMotorControl(Motor)
+    Motor.poller.status.connect(GUI.update_status)
+    Motor.queue.started.connect(Motor.watch_movement)
+    Motor.queue.changed.connect(GUI.update_queue)
+    Motor.connection.lost.connect(lambda: GUI.enable_buttons(False))
+    Motor.connection.restored.connect(lambda: GUI.enable_buttons(True))
+    Motor.poller.start()
+    Motor.queue.start()
+    Motor.connection.start()
     Motor.get_tablestatus()
     
 
@@ -2,7 +2,7 @@
 
 # Form implementation generated from reading ui file 'interface.ui'
 #
-# Created by: PyQt5 UI code generator 5.15.2
+# Created by: PyQt5 UI code generator 5.15.11
 #
 # WARNING: Any manual changes made to this file will be lost when pyuic5 is
 # run again.  Do not edit this file unless you know what you are doing.
@@ -538,6 +538,14 @@ class Ui_MainWindow(object):
         self.button_in_vivo.setSizePolicy(sizePolicy)
         self.button_in_vivo.setObjectName("button_in_vivo")
         self.verticalLayout.addWidget(self.button_in_vivo)
+        self.button_s2_scan = QtWidgets.QPushButton(self.tab)
+        sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Preferred)
+        sizePolicy.setHorizontalStretch(0)
+        sizePolicy.setVerticalStretch(0)
+        sizePolicy.setHeightForWidth(self.button_s2_scan.sizePolicy().hasHeightForWidth())
+        self.button_s2_scan.setSizePolicy(sizePolicy)
+        self.button_s2_scan.setObjectName("button_s2_scan")
+        self.verticalLayout.addWidget(self.button_s2_scan)
         self.gridLayout_4.addLayout(self.verticalLayout, 0, 0, 2, 1)
         self.button_s2_adjust = QtWidgets.QPushButton(self.tab)
         sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Preferred, QtWidgets.QSizePolicy.Preferred)
@@ -765,6 +773,8 @@ class Ui_MainWindow(object):
         self.button_in_vitro.setText(_translate("MainWindow", "IN VITRO"))
         self.button_in_vivo.setToolTip(_translate("MainWindow", "When clicking the button, both scatterer move into parking position (out of the beamline)."))
         self.button_in_vivo.setText(_translate("MainWindow", "IN VIVO"))
+        self.button_s2_scan.setToolTip(_translate("MainWindow", "Watches a folder for new Lynx images and moves the 2nd scatterer after each exposure until the field is flat."))
+        self.button_s2_scan.setText(_translate("MainWindow", "SCAN"))
         self.button_s2_adjust.setToolTip(_translate("MainWindow", "When clicking the button, the second scatterer adjusts its beam position (still in the beamline)."))
         self.button_s2_adjust.setText(_translate("MainWindow", "ADJUST"))
         self.tabWidget.setTabText(self.tabWidget.indexOf(self.tab), _translate("MainWindow", "Motor control"))